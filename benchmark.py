@@ -0,0 +1,257 @@
+"""
+Benchmarks for the nlre matcher.
+
+Run as a script:
+    python benchmark.py [--reference] [--quick] [--repeat N] [--json PATH]
+
+The workloads are timed at several sizes each, and the time of every run
+is printed together with its growth exponent: the slope of the time on a
+log-log scale between consecutive sizes, which is about 1 for work linear
+in the size, 2 for quadratic work and so on.
+
+    parse       SList parsing of sentences with nested sublists
+    compile     Pattern compilation, by the number of patterns
+    patternset  PatternSet.search, by the number of patterns
+    match, search, findall
+                the methods of Pattern with greedy and non-greedy
+                elements, sublists, :in lists and @ slice functions,
+                by the length of the sentence
+    input       Pattern.match of a short pattern with the sentence given as
+                a string, a list and a tuple, which is used without being
+                converted, by the length of the sentence
+    incremental one edit of a sentence kept by nlre.Incremental and the
+                matches after it, by the length of the sentence
+    adversarial stacked quantifiers, such as '# a # a # a # b', against
+                sentences which they don't match; a naive backtracking
+                matcher is exponential in the number of quantifiers, and
+                the memoized Program is expected to grow polynomially
+
+With --reference the adversarial workloads are also timed with the
+reference engine, nlre.compare, for the sizes it can handle.
+
+With --json the results are also written to a file as a JSON document,
+so that runs of different versions of the engine can be compared.
+"""
+
+import argparse
+import json
+import math
+import platform
+import time
+
+import nlre
+from slist import SList
+
+
+# (pattern, first word of the sentence, word the rest of the sentence is
+# made of, largest sentence length); the first word is one the pattern
+# requires, so the sentence isn't rejected before it is matched
+ADVERSARIAL = [
+    ('# a # a # a # b', 'b', 'a', 400),
+    ('# a # a # a # a # b', 'b', 'a', 400),
+    ('#? a #? a #? a #? b', 'b', 'a', 400),
+    ('&x@ [# a # a # b] c', 'c', 'a', 100),
+]
+
+# (name, pattern) of the workloads of the match, search and findall
+# benchmarks; the sentences are made by sentence()
+METHODS = ['match', 'search', 'findall']
+WORKLOADS = [
+    ('greedy', '#x w7 #y w13 #'),
+    ('non-greedy', '#?x w7 #?y w13 #?'),
+    ('sublists', '#? [#x [w2 #y]] #?'),
+    (':in', '&x:in [w1 w2 w3 w4 w5 w6 w7 w8 w9 w10 w11 w12] w40'),
+    ('@', '{3:6}x@ [w20 # w24] w25'),
+]
+
+# (name, pattern) of the workloads of the incremental benchmark; a
+# pattern of unbounded width is matched again at every offset before the
+# edit
+INCREMENTAL = [
+    ('bounded', 'w3 {1:3}x w5'),
+    ('unbounded', 'w1 #x w8'),
+]
+
+SIZES = [25, 50, 100, 200, 400]
+REFERENCE_SIZES = [5, 10, 15, 20]
+SENTENCE_SIZES = [100, 1000, 10000]
+PATTERN_COUNTS = [10, 100, 1000]
+
+
+def timed(fun, *args, repeat=1):
+    # the best time of `repeat` calls
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def sentence(n):
+    # a sentence of n elements: words w0 to w49 in turn, with a sublist
+    # in place of every tenth word
+    return SList(['w{0}'.format(i % 50) if i % 10 != 9
+                  else ['w1', ['w2', 'w{0}'.format(i % 7)]]
+                  for i in range(n)])
+
+
+def patterns(count):
+    # `count` distinct patterns which share leading words
+    return ['w{0} w{1} #x w{2}'.format(i % 50, i % 13, i % 7)
+            for i in range(count)]
+
+
+class Report:
+    """Prints the results as they come and keeps them for the JSON
+    output."""
+    def __init__(self):
+        self.results = []
+        self.previous = None
+
+    def header(self, benchmark):
+        print()
+        print(benchmark)
+        print('{0:<56} {1:>6} {2:>12} {3}'.format('case', 'size', 'seconds',
+                                                  'exponent'))
+        self.previous = None
+
+    def add(self, benchmark, case, size, seconds):
+        if self.previous and self.previous[0] == case:
+            n, t = self.previous[1:]
+            exponent = math.log(max(seconds, 1e-9) / max(t, 1e-9)) / \
+                math.log(size / n)
+            growth = '{0:5.2f}'.format(exponent)
+        else:
+            exponent = None
+            growth = '    -'
+        print('{0:<56} {1:>6} {2:>12.6f} {3}'.format(case, size, seconds,
+                                                     growth))
+        self.previous = (case, size, seconds)
+        self.results.append({'benchmark': benchmark, 'case': case,
+                             'size': size, 'seconds': seconds,
+                             'exponent': exponent})
+
+    def dump(self, path, args):
+        with open(path, 'w') as file:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'repeat': args.repeat,
+                       'results': self.results}, file, indent=1)
+
+
+def run_program(pattern, sen):
+    return pattern.match(sen)
+
+
+def run_reference(pattern, sen):
+    return nlre.compare(pattern, SList(sen))
+
+
+def bench_adversarial(report, name, fun, sizes, repeat):
+    report.header(name)
+    for (pat, first, word, largest) in ADVERSARIAL:
+        pattern = nlre.Pattern(pat)
+        for n in sizes:
+            if n > largest:
+                break
+            sen = [first] + [word] * (n - 1)
+            report.add(name, pat, n, timed(fun, pattern, sen, repeat=repeat))
+
+
+def bench_parse(report, sizes, repeat):
+    report.header('parse')
+    for n in sizes:
+        s = str(sentence(n))
+        report.add('parse', 'SList', n, timed(SList, s, repeat=repeat))
+
+
+def bench_compile(report, counts, repeat):
+    report.header('compile')
+    for count in counts:
+        pats = patterns(count)
+        nlre.purge()
+        report.add('compile', 'Pattern', count,
+                   timed(lambda: [nlre.Pattern(p) for p in pats],
+                         repeat=repeat))
+
+
+def bench_patternset(report, counts, repeat):
+    report.header('patternset')
+    sen = sentence(200)
+    for count in counts:
+        ps = nlre.PatternSet(patterns(count))
+        report.add('patternset', 'search', count,
+                   timed(ps.search, sen, repeat=repeat))
+
+
+def bench_methods(report, sizes, repeat):
+    for method in METHODS:
+        report.header(method)
+        for (name, pat) in WORKLOADS:
+            fun = getattr(nlre.Pattern(pat), method)
+            for n in sizes:
+                sen = sentence(n)
+                report.add(method, '{0} {1}'.format(name, pat), n,
+                           timed(fun, sen, repeat=repeat))
+
+
+def bench_input(report, sizes, repeat):
+    report.header('input')
+    pattern = nlre.Pattern('w0 #x w2')
+    for (case, convert) in [('string', str), ('list', list),
+                            ('tuple', nlre.freeze)]:
+        for n in sizes:
+            sen = convert(sentence(n))
+            report.add('input', case, n,
+                       timed(pattern.match, sen, repeat=repeat))
+
+
+def bench_incremental(report, sizes, repeat):
+    report.header('incremental')
+    for (name, pat) in INCREMENTAL:
+        pattern = nlre.Pattern(pat)
+        for n in sizes:
+            inc = nlre.Incremental(pattern, sentence(n))
+
+            def edit():
+                inc.replace(n // 2, n // 2 + 1, ['w7'])
+                inc.matches()
+            report.add('incremental', '{0} {1}'.format(name, pat), n,
+                       timed(edit, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--reference', action='store_true',
+                        help='also time the reference compare() engine')
+    parser.add_argument('--quick', action='store_true',
+                        help='only time the smaller sizes')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='report the best of this many runs')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the results to a JSON file')
+    args = parser.parse_args()
+
+    sizes, sentence_sizes, counts = SIZES, SENTENCE_SIZES, PATTERN_COUNTS
+    if args.quick:
+        sizes, sentence_sizes, counts = sizes[:3], sentence_sizes[:2], \
+            counts[:2]
+
+    report = Report()
+    bench_parse(report, sentence_sizes, args.repeat)
+    bench_compile(report, counts, args.repeat)
+    bench_patternset(report, counts, args.repeat)
+    bench_methods(report, sentence_sizes, args.repeat)
+    bench_input(report, sentence_sizes, args.repeat)
+    bench_incremental(report, sentence_sizes, args.repeat)
+    bench_adversarial(report, 'adversarial', run_program, sizes, args.repeat)
+    if args.reference:
+        bench_adversarial(report, 'adversarial compare', run_reference,
+                          REFERENCE_SIZES, args.repeat)
+    if args.json:
+        report.dump(args.json, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,514 +1,3072 @@
-"""
-docstring
-"""
-
-import re
-from collections import deque
-from keyword import iskeyword
-from slist import SList
-
-
-# global dictionary functions
-functions = {}
-
-
-class Pattern(list):
-    def __init__(self, arg):
-        slist = SList(arg)
-        super().__init__(pattern_init(slist))
-
-    def match(self, sen):
-        sen = SList(sen)
-        m = compare(self, sen)
-        if m is not None:
-            return UserMatch(m)
-        else:
-            return None
-
-    def search(self, sen):
-        sen = SList(sen)
-
-        # try to match the pattern against a slice of the sentence,
-        # starting from the 0th element, then the 1st element, and so on,
-        # until the slice sen[len(sen):] is a empty string;
-        # if all attempts are unsuccessful, return None
-        for i in range(len(sen)+1):
-            m = compare(self, sen[i:])
-            if m is not None:
-                return UserMatch(m)
-        else:
-            return None
-
-    def finditer(self, sen):
-        sen = SList(sen)
-
-        # try to match the pattern against a slice of the sentence,
-        # starting from the 0th element, then the 1st element, and so on,
-        # until the slice sen[len(sen):] is a empty string;
-        # if all attempts are unsuccessful, return None
-        for i in range(len(sen)+1):
-            m = compare(self, sen[i:])
-            if m is not None:
-                yield UserMatch(m)
-
-    def findall(self, sen):
-        return list(self.finditer(sen))
-
-
-def pattern_init(slist):
-    slist.reverse()
-    proccessed = []
-    while slist:
-        elem = slist.pop()
-        if isinstance(elem, SList):
-            proccessed.append(pattern_init(elem))
-        else:  # elem is a string
-            if elem[0] in "?!#&{":
-                proccessed.append(Special(elem, slist))
-            else:
-                proccessed.append(elem)
-    return proccessed
-
-
-# Pattern mathods aliased as level-module functions
-
-def match(pat, sen):
-    return Pattern(pat).match(sen)
-
-def search(pat, sen):
-    return Pattern(pat).search(sen)
-
-def finditer(pat, sen):
-    return Pattern(pat).finditer(sen)
-
-def findall(pat, sen):
-    return Pattern(pat).findall(sen)
-
-
-class Match(list):
-    def __init__(self, arg=None, name=None):
-        if isinstance(arg, list):
-            super().__init__(arg)
-        elif isinstance(arg, str):
-            super().__init__([arg])
-        elif arg is None:
-            super().__init__()
-
-        if name:
-            if is_valid_name(name):
-                self.name = name
-                setattr(self, self.name, [])
-                # this attribute will store the slice that matches the named
-                # special element
-            else:
-                raise ValueError("'{0}' is not a valid match ".format(name) +
-                                "name; presumably it is not alphanumerical"
-                                "or it is a Python keyword")
-
-    def __add__(self, obj):
-        if isinstance(obj, Match):
-            self.extend(obj)  # combine both matches
-            self.update(obj)
-            if hasattr(self, 'name'):
-                del self.name
-                # self.name won't be needed anymore
-            return self
-        elif obj is None:
-            return None
-        else:
-            raise TypeError("the object added to a Match object must be "
-                            "either another Match or None")
-
-    def append(self, obj):
-        # if the match object has the attribute "name", elements are appended
-        # both to the object and to the attribute list of the name "self.name"
-        super().append(obj)
-        if hasattr(self, 'name'):
-            getattr(self, self.name).append(obj)
-
-    def pop(self):
-        # if the match object has the attribute "name", elements are popped
-        # from both the object and from the attribute list of the name
-        # "self.name"
-        if hasattr(self, 'name'):
-            getattr(self, self.name).pop()
-        return super().pop()
-
-    def update(self, other):
-        self.__dict__.update(other.__dict__)
-
-    def as_sublist(self):
-        # return a match similar to self, the only difference in that
-        # the matched text becomes a sublist
-        container = Match()
-        container.update(self)
-        container.append(list(self))
-        return container
-
-
-def is_valid_name(s):
-    return s.isidentifier() and not iskeyword(s)
-
-
-class UserMatch:
-    def __init__(self, m):
-        self._m = str(SList(m))
-        for (attr, value) in m.__dict__.items():
-            setattr(self, attr, str(SList(value)))
-
-    def __call__(self):
-        return self._m
-
-
-class Special:
-    from_to = {
-        '?': (0, 1),
-        '!': (1, 1),
-        '#': (0, float('inf')),
-        '&': (1, float('inf'))
-    }
-
-    # the from-to notation
-    curly_mn = re.compile(r"""
-        \{      # Opening curly brace
-        (\d*)   # `from` value (possibly empty)
-        :       # Semicolon
-        (\d*)   # `to` value (possibly empty)
-        \}      # Closing curly brace
-        (.*)    # The rest of the special element: match name and functions
-    """, re.VERBOSE)
-
-    # the n-elements notation
-    curly_n = re.compile(r"""
-        \{      # Opening curly brace
-        (\d+)   # `from` value
-        \}      # Closing curly brace
-        (.*)    # The rest of the special element: match name and functions
-    """, re.VERBOSE)
-
-    params = re.compile(r'([:@])')
-    # used for splitting `params` at colons or at-signs
-
-    def __init__(self, s, slist):
-        self.slist = slist
-        self.s = s
-
-        for metachar in self.from_to:
-            if self.s.startswith(metachar):
-                from_, to = self.from_to[metachar]
-                rest = self.s[1:]
-                break
-        else:
-            # compare the element with the `from-to` notation pattern 
-            m = self.curly_mn.match(self.s)
-            if m:
-                # the `from-to` notation was used
-                # name groups
-                from_ = m.group(1)
-                to = m.group(2)
-                rest = m.group(3)
-
-                # convert `from_` and `to` to numbers (or infinity)
-                if from_:
-                    from_ = int(from_)
-                else:
-                    from_ = 0
-
-                if to:
-                    to = int(to)
-                else:
-                    to = float('inf')
-            else:
-                # compare the element with the `n elements` notation pattern
-                m = self.curly_n.match(self.s)
-                if m:
-                    # the `n elements` notation was used
-                    # name groups
-                    n = m.group(1)
-                    rest = m.group(2)
-                    n = int(n)
-                    from_, to = n, n
-                else:
-                    raise ValueError("The '{0}' element ".format(self.s) + 
-                                     "of the pattern is a string which "
-                                     "starts with a metacharacter -- "
-                                     "? ! # & or { -- but is not "
-                                     "a valid special element.")
-
-        if rest.startswith('?'):
-            self.greedy = False
-            rest = rest[1:]
-        else:
-            self.greedy = True
-
-        # Extract the match name and functions from the special element
-        # string.
-
-        # Create functions lists
-
-        elem_funs = []
-        slice_funs = []
-
-        # Check for functions which require an argument
-        if rest.endswith(':'):
-            # Create a special function using the 'pat's first element
-            arg = self.getarg()
-            elem_funs.append(lambda elem:
-                                compare(arg, elem, toplevel=False))
-            rest = rest[:-1]  # Remove the trailing colon
-        elif rest.endswith('@'):
-            arg = self.getarg()
-            slice_funs.append(lambda slice_:
-                                compare(arg, slice_, toplevel=False))
-            rest = rest[:-1]
-        elif rest.endswith(':in'):
-            elem_funs.append(self.make_in())
-            rest = rest[:-3]
-        elif rest.endswith(':notin'):
-            elem_funs.append(self.make_notin())
-            rest = rest[:-6]
-        elif rest.endswith('@in'):
-            slice_funs.append(self.make_in())
-            rest = rest[:-3]
-        elif rest.endswith('@notin'):
-            slice_funs.append(self.make_notin())
-            rest = rest[:-6]
-
-        del self.slist
-        # It won't be needed anymore.
-
-        # Split `rest` at colons and at-signs, and preserve those colons
-        # and at-signs as elements in the resulting list.
-        # If `rest` are
-        # 'name:fun1:fun2@fun3@fun4'
-        # then `splitted` will be
-        # ['name', ':', 'fun1', ':', 'fun2', '@', 'fun3', '@', 'fun4']
-        splitted = self.params.split(rest)
-
-        # We are going to pop elements from the start of the list
-        splitted = deque(splitted)
-
-        # Name of the match
-        self.name = splitted.popleft()
-
-        # Extracting functions
-        if not all(splitted):
-            # `splitted` has empty strings as its elements
-            raise ValueError("two delimiters (colon or at-sign) "
-                             "cannot be adjacent")
-
-        while splitted:
-            # At the start of each loop run the length of `splitted` is even
-            symbol = splitted.popleft()
-            fun = splitted.popleft()
-
-            if fun in {'in', 'notin'}:
-                raise ValueError("Functions 'in' and 'nnotin' can only occur "
-                                 "at the end of the special element string "
-                                 "in {0}".format(self.s))
-
-            if fun not in functions:
-                raise KeyError("the function name '{0}' is not ".format(fun) +
-                               "in the 'functions' dictionary")
-
-            if symbol == ":":
-                elem_funs.append(functions[fun])
-            elif symbol == "@":
-                slice_funs.append(functions[fun])
-
-        self.from_, self.to = from_, to
-        self.elem_funs = elem_funs
-        self.slice_funs = slice_funs
-
-    # Higher order functions for creating :in and :notin instances
-    def make_in(self):
-        arg = self.getarg()
-        if not isinstance(arg, list):
-            raise TypeError("the argument to :in must be a list "
-                            "in {0}".format(self.s))
-
-        def in_(elem):
-            for subpat in arg:
-                m = compare(subpat, elem, toplevel=False)
-                if m is not None:
-                    return m
-            else:
-                return None
-        return in_
-
-    def make_notin(self):
-        arg = self.getarg()
-        if not isinstance(arg, list):
-            raise TypeError("the argument to :notin must be a list "
-                            "in {0}".format(self.s))
-
-        def notin(elem):
-            for subpat in arg:
-                m = compare(subpat, elem, toplevel=False)
-                if m is not None:
-                    return False
-            else:
-                return True
-        return notin
-
-    def getarg(self):
-        try:
-            arg = self.slist.pop()
-        except IndexError:
-            raise ValueError("a function in a special element "
-                             "{0} requires an argument".format(self.s))
-        if isinstance(arg, list):
-            return pattern_init(arg)
-        else:  # "arg" is a string
-            return arg
-
-    def match(self, pat, sen, toplevel):
-        return SpecialMatching(self, pat, sen, toplevel).go()
-
-
-class SpecialMatching:
-    def __init__(self, special, pat, sen, toplevel):
-        self.__dict__.update(special.__dict__)
-        if self.greedy:
-            self.go = self.greedy1
-        else:
-            self.go = self.nongreedy
-        self.pat = pat.copy()
-        self.sen = deque(sen)
-        self.match = Match(name=self.name)
-        self.toplevel = toplevel
-
-    def greedy1(self):
-        if self.to == 0:
-            # maximal number of elements have been matched, test slices
-            return self.greedy2()
-        if not self.sen:
-            return self.greedy2()
-        # test sen[0] against the functions in elem_funs
-        for fun in self.elem_funs:
-            if not fun(self.sen[0]):
-                # one of the functions evaluated to False
-                return self.greedy2()
-        else:
-            self.from_ -= 1
-            self.to -= 1
-            self.match.append(self.sen.popleft())
-            return self.greedy1()    
-
-    def greedy2(self):
-        if self.from_ > 0:
-            # not enough elements have been matched
-            return None
-        # test the match against the functions in elem_funs
-        slice_rvs = [fun(self.match) for fun in self.slice_funs]
-        if all(slice_rvs):
-            # all functions evaluated to True
-            # compare the remaining part of the pattern with the remaining part
-            # of the sentence
-            m = compare(self.pat, list(self.sen), self.toplevel)
-            if m is not None:
-                # matching successful
-                for rv in slice_rvs:
-                    if isinstance(rv, Match):
-                        self.match.update(rv)
-                return self.match + m
-            else:
-                # move the last element back from 'match' to 'sen'
-                if self.match:
-                    self.from_ += 1
-                    self.sen.appendleft(self.match.pop())
-                    return self.greedy2()
-                else:
-                    return None
-        else:
-            # some of the functions returned evaluated to False
-            # move the last element back from 'match' to 'sen'
-            if self.match:
-                self.from_ += 1
-                self.sen.appendleft(self.match.pop())
-                return self.greedy2()
-            else:
-                return None
-
-    def nongreedy(self):
-        if self.to < 0:
-            return None
-        if not self.sen:
-            return None
-        for fun in self.elem_funs:
-            if not fun(self.sen[0]):
-                return None
-        if self.from_ > 0:
-            self.from_ -= 1
-            self.to -= 1
-            self.match.append(self.sen.popleft())
-            return self.nongreedy()
-        else:
-            slice_rvs = [fun(self.match) for fun in self.slice_funs]
-            if all(slice_rvs):
-                m = compare(self.pat, list(self.sen), self.toplevel)
-                if m is not None:
-                    # matching successful
-                    for rv in slice_rvs:
-                        if isinstance(rv, Match):
-                            self.match.update(rv)
-                    return self.match + m
-                else:
-                    self.from_ -= 1
-                    self.to -= 1
-                    self.match.append(self.sen.popleft())
-                    return self.nongreedy()
-            else:
-                self.from_ -= 1
-                self.to -= 1
-                self.match.append(self.sen.popleft())
-                return self.nongreedy()
-
-
-def compare(pat, sen, toplevel=True):
-    if toplevel:
-        if not pat:
-            return Match()
-        elif isinstance(pat[0], Special):
-            special = pat[0]
-            return special.match(pat[1:], sen, toplevel)
-        elif not sen:
-            return None
-    else:
-        if not pat and not sen:
-            # comparing the pattern has finished successfully
-            return Match()
-        elif not pat:
-            # the pattern and the sentence are of unequal lengths
-            return None
-        elif isinstance(pat[0], Special):
-            special = pat[0]
-            return special.match(pat[1:], sen, toplevel)
-        elif not sen:
-            return None
-
-    # the pattern and the sentence are non-empty
-
-    if isinstance(pat[0], str) and isinstance(sen[0], str):
-    # pat[0] and sen[0] are regular words
-        if pat[0].lower() == sen[0].lower():
-            # pat[0] and sen[0] are equal, case-insentitive;
-            # compare the remaining part of the pattern
-            # and the sentence
-            return Match(sen[0]) + compare(pat[1:], sen[1:], toplevel)
-        else:
-            return None
-    elif isinstance(pat[0], list) and isinstance(sen[0], list):
-        # pat[0] and sen[0] are sublists
-        m = compare(pat[0], sen[0], toplevel=False)
-        if m is not None:
-            # pat[0] and sen[0] match each other;
-            # compare the remaining part of the pattern
-            # and the sentence
-            return m.as_sublist() + \
-                   compare(pat[1:], sen[1:], toplevel)
-        else:
-            return None
-    else:
-        # pat[0] and sen[0] are of different types
-        return None
+"""
+docstring
+"""
+
+import argparse
+import asyncio
+import gc
+import importlib
+import json
+import mmap
+import os
+import pickle
+import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import weakref
+from array import array
+from collections import Counter, deque, namedtuple, OrderedDict
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from itertools import islice
+from keyword import iskeyword
+from sys import intern
+from slist import SList, iterparse
+
+
+# global dictionary functions
+functions = {}
+
+
+class Pattern(list):
+    tokenizer = None
+    registry = None
+
+    def __init__(self, arg, case='lower', vocabulary=None, registry=None,
+                 tokenizer=None):
+        # `case` is the name of the function in the 'cases' dictionary
+        # which words are folded with before they are compared; a pattern
+        # compiled with a Vocabulary compares word ids instead, folded as
+        # the vocabulary folds them, and also matches EncodedSentences.
+        # The functions of special elements are looked up in `registry`,
+        # which is then frozen, or in the 'functions' dictionary.
+        # Sentences given as strings are split into words by `tokenizer`,
+        # if there is one; see tokens().
+        slist = SList(arg)
+        super().__init__(pattern_init(slist, registry))
+        self.tokenizer = tokenizer
+        self.registry = registry
+        if vocabulary is None:
+            self.program = Program(self, get_folding(case))
+        else:
+            self.program = Program(self, vocabulary)
+        if registry is not None:
+            registry.freeze()
+
+    def text(self, sen):
+        # prepare a sentence for matching
+        return self.program.folding.text(sen, self.tokenizer)
+
+    def __getstate__(self):
+        # The registry is left out, like that of the special elements:
+        # the pattern gets the one given to load() when it is loaded.
+        state = self.__dict__.copy()
+        state.pop('registry', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        registry = loading_registry()
+        if registry is not None:
+            self.registry = registry
+            registry.freeze()
+
+    def match(self, sen, tracer=None):
+        # `tracer` is a Tracer which counts the work of the call and may
+        # limit it; the same goes for the methods below
+        if tracer is not None:
+            tracer.start()
+        text = self.text(sen)
+        if self.program.rejects(text):
+            return None
+        m = self.program.match(text, 0, len(text), tracer=tracer)
+        if m is not None:
+            return UserMatch(m)
+        else:
+            return None
+
+    def search(self, sen, tracer=None):
+        if tracer is not None:
+            tracer.start()
+        for m in self.program.finditer(self.text(sen), tracer=tracer):
+            return UserMatch(m)
+        else:
+            return None
+
+    def finditer(self, sen, overlapped=True, tracer=None):
+        # with `overlapped`, a match is tried at every offset of the
+        # sentence; otherwise, like re.finditer, the search for the next
+        # match resumes where the previous one has ended; the clock of
+        # the tracer stops while a match is handed over
+        if tracer is not None:
+            tracer.start()
+        for m in self.program.finditer(self.text(sen), overlapped, tracer):
+            if tracer is not None:
+                tracer.pause()
+            yield UserMatch(m)
+            if tracer is not None:
+                tracer.resume()
+
+    def findall(self, sen, overlapped=True, tracer=None):
+        return list(self.finditer(sen, overlapped, tracer))
+
+    # Asynchronous versions of the methods above, for use in asyncio
+    # programs. The matching is done in `executor`, by default the one
+    # get_executor() returns, so the event loop goes on while it lasts.
+    # A thread pool bounds the number of matches done at a time; the
+    # others wait for a thread in the order they have come. finditer()
+    # is resumed in the executor once per match, so long searches take
+    # turns with other calls.
+
+    async def amatch(self, sen, tracer=None, executor=None):
+        """
+        >>> import asyncio
+        >>> p = Pattern('the #x')
+        >>> async def main():
+        ...     m = await p.amatch('the cat')
+        ...     return m.x, [m.x async for m in p.afinditer('the a the b')]
+        >>> asyncio.run(main())
+        ('cat', ['a the b', 'b'])
+        """
+        return await run_async(executor, self.match, sen, tracer)
+
+    async def asearch(self, sen, tracer=None, executor=None):
+        return await run_async(executor, self.search, sen, tracer)
+
+    async def afinditer(self, sen, overlapped=True, tracer=None,
+                        executor=None):
+        matches = self.finditer(sen, overlapped, tracer)
+        while True:
+            m = await run_async(executor, next, matches, None)
+            if m is None:
+                return
+            yield m
+
+    async def afindall(self, sen, overlapped=True, tracer=None,
+                       executor=None):
+        return [m async for m in self.afinditer(sen, overlapped, tracer,
+                                                executor)]
+
+    def info(self):
+        """Return what is known about the sentences the pattern matches
+        before it is compared with them: the least and the greatest number
+        of elements of a match (the greatest may be infinite), and the
+        regular words a sentence must contain at the top level.
+
+        >>> info = Pattern('the {2:3} of #? [a #] Cat').info()
+        >>> info.min_width, info.max_width, sorted(info.literals)
+        (6, inf, ['cat', 'of', 'the'])
+
+        A sentence with fewer elements, or without one of the words, is
+        rejected by match() and search() without being compared with the
+        pattern. The words are folded, as the pattern compares them, also
+        when it is compiled with a Vocabulary:
+
+        >>> Pattern('The #x', vocabulary=Vocabulary()).info().literals
+        frozenset({'the'})
+        """
+        program = self.program
+        literals = program.literals
+        if isinstance(program.folding, Vocabulary):
+            # the keys are the ids of the folded words
+            literals = frozenset(program.folding.words[key]
+                                 for key in literals)
+        return PatternInfo(program.min_width, program.width, literals)
+
+    def stream(self, tokens, overlapped=True):
+        """Generate the matches of the pattern in a stream of tokens, as
+        (offset, match) pairs.
+
+        `tokens` is any iterable of the elements of a sentence, words or
+        lists, which may have no end. The offset is the position of the
+        match in the stream, and the offsets the match object gives are
+        relative to it. The matches are those finditer() would find in
+        the whole stream, and each is generated as soon as the tokens
+        after it can no longer change it.
+
+        >>> p = Pattern('error {1:2}x end')
+        >>> log = 'ok error disk full end ok error end error net end'
+        >>> for (offset, m) in p.stream(iter(log.split())):
+        ...     print(offset, m(), '|', m.x, m.span())
+        1 error disk full end | disk full (0, 4)
+        8 error net end | net (0, 3)
+
+        A match is tried as soon as the tokens following its offset are as
+        many as the longest possible match needs, and one more: a window.
+        At most two windows of tokens are kept. If the pattern has a # or &
+        element, a match may be of any length, and the tokens are buffered
+        until the stream ends.
+
+        >>> def read(words):
+        ...     for word in words.split():
+        ...         print('read', word)
+        ...         yield word
+        >>> for (offset, m) in p.stream(read('error disk end ok ok ok')):
+        ...     print(offset, m())
+        read error
+        read disk
+        read end
+        read ok
+        read ok
+        0 error disk end
+        read ok
+        """
+        for (offset, m) in self.program.stream(tokens, overlapped):
+            yield offset, UserMatch(m)
+
+    # Batch versions of the methods above. The sentences are sent in
+    # chunks of `chunksize` to a pool of `workers` processes (by default,
+    # one per CPU). If `ordered` is true, the results are generated in the
+    # order of the sentences; otherwise they are generated as soon as they
+    # are ready, as (index of the sentence, result) pairs. `mp_context`
+    # is the multiprocessing context the processes are started with.
+
+    def match_many(self, sens, workers=None, chunksize=64, ordered=True,
+                   mp_context=None):
+        return run_many(self, 'match', sens, workers, chunksize, ordered,
+                        mp_context)
+
+    def search_many(self, sens, workers=None, chunksize=64, ordered=True,
+                    mp_context=None):
+        return run_many(self, 'search', sens, workers, chunksize, ordered,
+                        mp_context)
+
+    def findall_many(self, sens, workers=None, chunksize=64, ordered=True,
+                     mp_context=None):
+        return run_many(self, 'findall', sens, workers, chunksize, ordered,
+                        mp_context)
+
+
+def run_many(pattern, method, sens, workers, chunksize, ordered,
+             mp_context=None):
+    """Apply a method of the pattern to each of the sentences in a pool of
+    worker processes.
+
+    The pattern, together with the 'functions' dictionary and the registry
+    of the pattern, if it has one, is sent to each worker once, when it
+    starts; afterwards only the sentences and the
+    results travel between the processes. At most two chunks per worker
+    are queued at a time, so `sens` may be a long iterator.
+
+    >>> p = Pattern('the #x')
+    >>> [m.x for m in p.match_many(['the cat', 'the dog'], workers=2)]
+    ['cat', 'dog']
+
+    The pattern is sent pickled, and the worker unpickles it after adding
+    the functions to its dictionary, as the special elements look their
+    functions up by name. So a worker need not be forked from a process
+    which has the functions already:
+
+    >>> from multiprocessing import get_context
+    >>> functions['islower'] = str.islower
+    >>> p = Pattern('the &x:islower')
+    >>> [m and m.x for m in p.match_many(['the cat', 'the Dog'], workers=2,
+    ...                                  mp_context=get_context('spawn'))]
+    ['cat', None]
+    >>> del functions['islower']
+
+    The functions of a registry need to be picklable only where the
+    workers aren't forked:
+
+    >>> tenant = Registry({'islower': lambda word: word.islower()})
+    >>> p = Pattern('the &x:islower', registry=tenant)
+    >>> [m and m.x for m in p.match_many(['the cat', 'the Dog'], workers=2,
+    ...                                  mp_context=get_context('fork'))]
+    ['cat', None]
+
+    The vocabulary of a pattern compiled with one goes with the pattern,
+    and EncodedSentences are sent as their word ids only. The words given
+    ids after the pool has started, as when `sens` encodes sentences as
+    it goes, are sent along with the chunks:
+
+    >>> v = Vocabulary()
+    >>> p = Pattern('the #x', vocabulary=v)
+    >>> sens = (v.encode(s) for s in ['the cat', 'a dog', 'the cow'])
+    >>> [m and m.x for m in p.match_many(sens, workers=2, chunksize=1)]
+    ['cat', None, 'cow']
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    sens = iter(sens)
+    chunks = iter(lambda: list(islice(sens, chunksize)), [])
+    vocabulary = pattern.program.folding
+    if isinstance(vocabulary, Vocabulary):
+        start = len(vocabulary.words)
+    else:
+        vocabulary = None
+    initargs = (pickle.dumps(pattern, pickle.HIGHEST_PROTOCOL), functions,
+                pattern.registry)
+    with ProcessPoolExecutor(workers, mp_context, initializer=init_worker,
+                             initargs=initargs) as executor:
+        pending = deque()  # (index of the first sentence, future)
+        index = 0
+        while True:
+            for chunk in islice(chunks, 2 * workers - len(pending)):
+                words = None
+                if vocabulary is not None and len(vocabulary.words) > start:
+                    words = vocabulary.since(start)
+                future = executor.submit(work, method, chunk, words)
+                pending.append((index, future))
+                index += len(chunk)
+            if not pending:
+                break
+            if ordered:
+                (_, future) = pending.popleft()
+                yield from future.result()
+            else:
+                wait([f for (i, f) in pending], return_when=FIRST_COMPLETED)
+                for (start, future) in [item for item in pending
+                                        if item[1].done()]:
+                    pending.remove((start, future))
+                    yield from enumerate(future.result(), start)
+
+
+# the pattern installed in a worker process by run_many
+worker_pattern = None
+
+
+def init_worker(data, funs, registry):
+    global worker_pattern
+    functions.update(funs)
+    worker_pattern = unpickle(data, registry)
+
+
+def work(method, sens, words=None):
+    # `words` are the (start, words, folded) the vocabulary of the pattern
+    # has gained since the pool has started, if any
+    if words is not None:
+        worker_pattern.program.folding.extend(*words)
+    fun = getattr(worker_pattern, method)
+    return [fun(sen) for sen in sens]
+
+
+# The default executor of the asynchronous methods of patterns
+
+default_executor = None  # the default executor of run_async()
+default_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the executor the asynchronous methods of patterns use by
+    default: a thread pool made when it is first needed, with a thread
+    per CPU, up to 4. Assign another executor to nlre.default_executor
+    to use it instead."""
+    global default_executor
+    with default_executor_lock:
+        if default_executor is None:
+            default_executor = ThreadPoolExecutor(
+                min(os.cpu_count() or 1, 4), thread_name_prefix='nlre')
+        return default_executor
+
+
+async def run_async(executor, fun, *args):
+    if executor is None:
+        executor = get_executor()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, fun, *args)
+
+
+# Saving compiled patterns to files and loading them back
+
+# The format of the files written by save(): a pickle of the pair
+# (FORMAT, patterns).
+FORMAT = 'nlre-patterns-1'
+
+
+def save(patterns, path):
+    """Write compiled patterns to a file, for load() to read back.
+
+    `patterns` may be a Pattern or any picklable container of them, such
+    as a list or a dictionary. The patterns are stored as they are after
+    compiling, so loading them involves no parsing. Functions are stored
+    by name, and they must be in the 'functions' dictionary, or in the
+    registry given to load(), under the same names when the patterns are
+    loaded.
+
+    >>> import os, tempfile
+    >>> functions['islower'] = str.islower
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> path = os.path.join(tmp.name, 'patterns')
+    >>> save({'greeting': Pattern('hello #x:islower')}, path)
+    >>> load(path)['greeting'].match('Hello world').x
+    'world'
+    >>> del functions['islower']
+    >>> load(path)
+    Traceback (most recent call last):
+        ...
+    KeyError: "the function name 'islower' is not in the 'functions' dictionary"
+    >>> with open(path, 'wb') as file:
+    ...     pickle.dump(['not', 'patterns'], file)
+    >>> load(path)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+        ...
+    ValueError: '...' is not a file of nlre patterns
+
+    Patterns compiled with a registry are stored without it, and are given
+    one again when they are loaded:
+
+    >>> tenant = Registry({'islower': lambda word: word.islower()})
+    >>> save(Pattern('hello #x:islower', registry=tenant), path)
+    >>> p = load(path, registry=tenant)
+    >>> p.match('Hello world').x, p.registry is tenant
+    ('world', True)
+    >>> tmp.cleanup()
+    """
+    with open(path, 'wb') as file:
+        pickle.dump((FORMAT, patterns), file, pickle.HIGHEST_PROTOCOL)
+
+
+def load(path, registry=None):
+    """Read the patterns written by save() to a file.
+
+    The functions of the patterns are looked up in `registry`, if one is
+    given, and otherwise in the 'functions' dictionary.
+
+    The file is a pickle, and unpickling may run any code the file names,
+    so it must come from a trusted source. ValueError is raised if the
+    file is a pickle of something else.
+
+    The file is memory-mapped and unpickled in one pass, rather than read
+    into a string first. The garbage collector is paused meanwhile: the
+    many small objects of the patterns would otherwise set it off again
+    and again, to no avail, as all of them are kept.
+    """
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        with open(path, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0,
+                           access=mmap.ACCESS_READ) as data:
+                obj = unpickle(data, registry)
+    finally:
+        if collecting:
+            gc.enable()
+    if not (isinstance(obj, tuple) and len(obj) == 2 and obj[0] == FORMAT):
+        raise ValueError("'{0}' is not a file of nlre patterns".format(path))
+    return obj[1]
+
+
+# the registries patterns are being unpickled with, per thread
+unpickling = threading.local()
+
+
+def unpickle(data, registry=None):
+    # unpickle patterns, with their functions looked up in `registry`
+    unpickling.registry = registry
+    try:
+        return pickle.loads(data)
+    finally:
+        unpickling.registry = None
+
+
+def loading_registry():
+    # the registry of the patterns being unpickled in this thread, if any
+    return getattr(unpickling, 'registry', None)
+
+
+# The static information about a pattern, as Pattern.info() returns it
+
+PatternInfo = namedtuple('PatternInfo', ['min_width', 'max_width',
+                                         'literals'])
+
+
+def pattern_init(slist, registry=None):
+    slist.reverse()
+    proccessed = []
+    while slist:
+        elem = slist.pop()
+        if isinstance(elem, SList):
+            proccessed.append(pattern_init(elem, registry))
+        else:  # elem is a string
+            if elem[0] in "?!#&{":
+                proccessed.append(Special(elem, slist, registry))
+            else:
+                proccessed.append(elem)
+    return proccessed
+
+
+class PatternSet:
+    """A set of patterns matched against a sentence together.
+
+    The leading regular words of the patterns are merged into a trie, and
+    a pattern leaves the trie at its first special element or sublist.
+    Walking the trie along the sentence selects the patterns whose
+    leading words are there, so only those are handed to the matcher, and
+    the sentence is prepared once for all of them. The patterns must all
+    fold words the same way, and split sentences with the same tokenizer;
+    `case`, `vocabulary`, `registry` and `tokenizer` apply to those given
+    as strings, as they do to Pattern. By default, the tokenizer is that
+    of the Pattern objects given.
+
+    The results are dictionaries which map the positions of the matching
+    patterns in the set to their match objects:
+
+    >>> ps = PatternSet(['big bad #x', 'big #y', 'small #z', '#? bad'])
+    >>> sorted((i, m()) for (i, m) in ps.match('big bad wolf').items())
+    [(0, 'big bad wolf'), (1, 'big bad wolf'), (3, 'big bad')]
+    >>> ps.search('the small cat')[2].z
+    'cat'
+    """
+    def __init__(self, patterns, case='lower', vocabulary=None,
+                 registry=None, tokenizer=None):
+        patterns = list(patterns)
+        if tokenizer is None:
+            tokenizer = next((pat.tokenizer for pat in patterns
+                              if isinstance(pat, Pattern)), None)
+        self.tokenizer = tokenizer
+        if vocabulary is None:
+            self.folding = get_folding(case)
+        else:
+            self.folding = vocabulary
+        self.patterns = [pat if isinstance(pat, Pattern)
+                         else Pattern(pat, case, vocabulary, registry,
+                                      tokenizer)
+                         for pat in patterns]
+        if any(p.program.folding is not self.folding for p in self.patterns):
+            raise ValueError("the patterns of a PatternSet must all fold "
+                             "words the same way")
+        if any(p.tokenizer != tokenizer for p in self.patterns):
+            raise ValueError("the patterns of a PatternSet must all split "
+                             "sentences with the same tokenizer")
+        self.trie = TrieNode()
+        for (index, pattern) in enumerate(self.patterns):
+            node = self.trie
+            for word in pattern.program.prefix:
+                node = node.children.setdefault(word, TrieNode())
+            node.indices.append(index)
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def candidates(self, keys, i):
+        # indices of the patterns whose leading words occur at keys[i]
+        node = self.trie
+        yield from node.indices
+        for j in range(i, len(keys)):
+            node = node.children.get(keys[j])
+            if node is None:
+                break
+            yield from node.indices
+
+    def match(self, sen):
+        text = self.folding.text(sen, self.tokenizer)
+        found = {}
+        for index in sorted(self.candidates(text.keys, 0)):
+            program = self.patterns[index].program
+            if program.rejects(text):
+                continue
+            m = program.match(text, 0, len(text))
+            if m is not None:
+                found[index] = UserMatch(m)
+        return found
+
+    def search(self, sen):
+        # the first match of each pattern, as Pattern.search would find it
+        text = self.folding.text(sen, self.tokenizer)
+        found = {}
+        failed = {}  # memo tables, one per pattern
+        rejected = set()  # patterns the sentence can't contain a match of
+        for i in range(len(text)+1):
+            for index in self.candidates(text.keys, i):
+                if index in found or index in rejected:
+                    continue
+                program = self.patterns[index].program
+                if index not in failed:
+                    # the first time the pattern is a candidate
+                    if program.rejects(text):
+                        rejected.add(index)
+                        continue
+                    failed[index] = set()
+                m = program.match(text, i, len(text), failed=failed[index])
+                if m is not None:
+                    found[index] = UserMatch(m)
+            if len(found) + len(rejected) == len(self.patterns):
+                break
+        return dict(sorted(found.items()))
+
+
+class TrieNode:
+    def __init__(self):
+        self.children = {}  # regular word -> TrieNode
+        self.indices = []  # patterns whose leading words end here
+
+
+class CorpusIndex:
+    """A collection of sentences stored in an SQLite database, with an
+    inverted index from words to the sentences containing them.
+
+    A search for a pattern only reads the sentences which contain the
+    words every match must contain: the regular words at the top level of
+    the pattern, and one of the words of a ':' argument or a :in list of
+    words which tests at least one element. Only those candidates are
+    compared with the pattern, so a search for rare words reads a small
+    part of the collection.
+
+    >>> index = CorpusIndex(':memory:')
+    >>> index.add_many(['the cat sat', 'a dog barked', 'the dog sat down'])
+    [1, 2, 3]
+    >>> [(i, m()) for (i, m) in index.search('the &x:in [dog cow] sat')]
+    [(3, 'the dog sat')]
+    >>> index.candidates(Pattern('!:in [dog cow] sat'))
+    [3]
+
+    `path` is the file of the database. The words are folded according to
+    `case`, as Pattern folds them, and the patterns searched for must fold
+    words the same way; the case of an existing index is that it was made
+    with.
+
+    With a `tokenizer`, the sentences, which must then be given as
+    strings, are stored as they are and split by the tokenizer, both when
+    they are indexed and when they are compared with patterns. Patterns
+    with a tokenizer must have the same one. The tokenizer isn't stored
+    in the database; an index must be opened again with the one it was
+    made with.
+
+    >>> index = CorpusIndex(':memory:', tokenizer=punctuation)
+    >>> index.add('in a low voice: go')
+    1
+    >>> [m() for (i, m) in index.search('low voice : #')]
+    ['low voice : go']
+    """
+    # the key of the postings of the sentences which contain sublists:
+    # a sublist may match a ':' argument or a :in list in place of a word
+    SUBLIST = '[]'
+
+    def __init__(self, path, case=None, tokenizer=None):
+        self.tokenizer = tokenizer
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS sentences (
+                    id INTEGER PRIMARY KEY, sentence TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS postings (
+                    word TEXT, id INTEGER, PRIMARY KEY (word, id))
+                    WITHOUT ROWID;
+            """)
+            row = self.db.execute("SELECT value FROM meta "
+                                  "WHERE key = 'case'").fetchone()
+            if row is None:
+                self.case = case or 'lower'
+                self.db.execute("INSERT INTO meta VALUES ('case', ?)",
+                                (self.case,))
+            elif case is None or case == row[0]:
+                self.case = row[0]
+            else:
+                raise ValueError("the index folds words with case "
+                                 "'{0}', not '{1}'".format(row[0], case))
+        self.folding = get_folding(self.case)
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM sentences").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def add(self, sen):
+        """Store a sentence and return its id."""
+        return self.add_many([sen])[0]
+
+    def add_many(self, sens):
+        """Store sentences in one transaction and return their ids."""
+        ids = []
+        with self.db:
+            for sen in sens:
+                if self.tokenizer is None:
+                    sen = SList(sen)
+                    stored = str(sen)
+                elif isinstance(sen, str):
+                    stored, sen = sen, self.tokenizer(sen)
+                else:
+                    raise TypeError("the sentences of an index with a "
+                                    "tokenizer must be strings")
+                cursor = self.db.execute("INSERT INTO sentences (sentence) "
+                                         "VALUES (?)", (stored,))
+                words = {self.folding(elem) if isinstance(elem, str)
+                         else self.SUBLIST for elem in sen}
+                self.db.executemany("INSERT INTO postings VALUES (?, ?)",
+                                    [(word, cursor.lastrowid)
+                                     for word in words])
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def sentence(self, id):
+        """Return the SList of the sentence of the id."""
+        row = self.db.execute("SELECT sentence FROM sentences WHERE id = ?",
+                              (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return SList(self.split(row[0]))
+
+    def split(self, stored):
+        # the elements of a stored sentence
+        return tokens(stored, self.tokenizer)
+
+    def requirements(self, pattern):
+        # Groups of words: a sentence matched by the pattern contains some
+        # word of each group at its top level.
+        program = pattern.program
+        if not (isinstance(program.folding, Folding) and
+                program.folding.case == self.case):
+            raise ValueError("the pattern must fold words with case "
+                             "'{0}', as the index does".format(self.case))
+        if pattern.tokenizer not in (None, self.tokenizer):
+            raise ValueError("the pattern must split sentences with the "
+                             "tokenizer of the index")
+        groups = [[word] for word in sorted(program.literals)]
+        for node in program.nodes:
+            if not (isinstance(node, Special) and node.from_ >= 1):
+                continue
+            for fun in node.elem_funs:
+                if type(fun) is ArgFunction and fun.program.word is not None:
+                    groups.append([fun.program.word, self.SUBLIST])
+                elif type(fun) is InFunction and fun.words is not None:
+                    groups.append(sorted(fun.words) + [self.SUBLIST])
+        return groups
+
+    def query(self, pattern, columns):
+        # the rows of the candidate sentences for the pattern
+        groups = self.requirements(pattern)
+        sql = "SELECT {0} FROM sentences".format(columns)
+        params = []
+        if groups:
+            sql += " WHERE id IN ({0})".format(" INTERSECT ".join(
+                "SELECT id FROM postings WHERE word IN ({0})".format(
+                    ", ".join("?" * len(group))) for group in groups))
+            for group in groups:
+                params.extend(group)
+        return self.db.execute(sql + " ORDER BY id", params)
+
+    def candidates(self, pattern):
+        """Return the ids of the sentences which may contain a match of
+        the pattern."""
+        return [id for (id,) in self.query(pattern, "id")]
+
+    def search(self, pattern):
+        """Generate the (id, match object) pairs of the sentences which
+        contain a match of the pattern, with its first match, in the order
+        of the ids. `pattern` may be a Pattern or a string."""
+        if not isinstance(pattern, Pattern):
+            pattern = Pattern(pattern, self.case, tokenizer=self.tokenizer)
+        for (id, sentence) in self.query(pattern, "id, sentence"):
+            # the sentence is split as it was when it was indexed, rather
+            # than by the tokenizer of the pattern
+            m = pattern.search(self.split(sentence))
+            if m is not None:
+                yield id, m
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize',
+                                     'currsize'])
+
+
+class PatternCache:
+    """A bounded, thread-safe LRU cache of Pattern objects, keyed by the
+    pattern strings they were compiled from.
+
+    The module-level functions compile their patterns through the `cache`
+    instance, so a pattern string used repeatedly is parsed only once.
+    Functions of special elements are looked up in the 'functions'
+    dictionary when a pattern is compiled; purge() the cache after
+    rebinding a function name used by cached patterns.
+
+    >>> c = PatternCache(maxsize=2)
+    >>> c.get('a #x') is c.get('a #x')
+    True
+    >>> _ = c.get('b'), c.get('c')  # 'a #x' is the least recently used
+    >>> c.info()
+    CacheInfo(hits=1, misses=3, maxsize=2, currsize=2)
+    >>> c.purge()
+    >>> c.info()
+    CacheInfo(hits=0, misses=0, maxsize=2, currsize=0)
+    """
+    def __init__(self, maxsize=512):
+        self._patterns = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self.hits = self.misses = 0
+
+    def get(self, pat):
+        """Return the compiled Pattern for `pat`.
+
+        Patterns given as lists are compiled without being cached.
+        """
+        if not isinstance(pat, str):
+            return Pattern(pat)
+        with self._lock:
+            try:
+                pattern = self._patterns[pat]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._patterns.move_to_end(pat)
+                return pattern
+
+        # compile outside the lock, so that other threads are not held up;
+        # if two threads compile the same pattern, the first one is kept
+        pattern = Pattern(pat)
+        with self._lock:
+            pattern = self._patterns.setdefault(pat, pattern)
+            self._patterns.move_to_end(pat)
+            self._evict()
+        return pattern
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        with self._lock:
+            self._maxsize = maxsize
+            self._evict()
+
+    def _evict(self):
+        while len(self._patterns) > self._maxsize:
+            self._patterns.popitem(last=False)
+
+    def purge(self):
+        """Remove all the patterns and reset the counters."""
+        with self._lock:
+            self._patterns.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self._maxsize,
+                             len(self._patterns))
+
+
+# cache of the patterns compiled by the module-level functions
+cache = PatternCache()
+
+
+def purge():
+    """Clear the cache of compiled patterns."""
+    cache.purge()
+
+
+# Pattern mathods aliased as level-module functions
+
+def match(pat, sen):
+    return cache.get(pat).match(sen)
+
+def search(pat, sen):
+    return cache.get(pat).search(sen)
+
+def finditer(pat, sen, overlapped=True):
+    return cache.get(pat).finditer(sen, overlapped)
+
+def findall(pat, sen, overlapped=True):
+    return cache.get(pat).findall(sen, overlapped)
+
+
+class Match(list):
+    def __init__(self, arg=None, name=None):
+        if isinstance(arg, list):
+            super().__init__(arg)
+        elif isinstance(arg, str):
+            super().__init__([arg])
+        elif arg is None:
+            super().__init__()
+
+        if name:
+            if is_valid_name(name):
+                self.name = name
+                setattr(self, self.name, [])
+                # this attribute will store the slice that matches the named
+                # special element
+            else:
+                raise ValueError("'{0}' is not a valid match ".format(name) +
+                                "name; presumably it is not alphanumerical"
+                                "or it is a Python keyword")
+
+    def __add__(self, obj):
+        if isinstance(obj, Match):
+            self.extend(obj)  # combine both matches
+            self.update(obj)
+            if hasattr(self, 'name'):
+                del self.name
+                # self.name won't be needed anymore
+            return self
+        elif obj is None:
+            return None
+        else:
+            raise TypeError("the object added to a Match object must be "
+                            "either another Match or None")
+
+    def append(self, obj):
+        # if the match object has the attribute "name", elements are appended
+        # both to the object and to the attribute list of the name "self.name"
+        super().append(obj)
+        if hasattr(self, 'name'):
+            getattr(self, self.name).append(obj)
+
+    def pop(self):
+        # if the match object has the attribute "name", elements are popped
+        # from both the object and from the attribute list of the name
+        # "self.name"
+        if hasattr(self, 'name'):
+            getattr(self, self.name).pop()
+        return super().pop()
+
+    def update(self, other):
+        self.__dict__.update(other.__dict__)
+
+    def as_sublist(self):
+        # return a match similar to self, the only difference in that
+        # the matched text becomes a sublist
+        container = Match()
+        container.update(self)
+        container.append(list(self))
+        return container
+
+
+def is_valid_name(s):
+    return s.isidentifier() and not iskeyword(s)
+
+
+class UserMatch:
+    """The result of a successful match.
+
+    Calling the object returns the matched fragment of the sentence, and
+    the named groups are its attributes. The object only holds the spans
+    of the match and its groups in the sentence; the strings are built
+    when they are asked for.
+
+    >>> m = Pattern('one #x [#y four]').match('one two [three four] five')
+    >>> m(), m.x, m.y
+    ('one two [three four]', 'two', 'three')
+    >>> m.span(), m.spans()
+    ((0, 3), {'x': (1, 2), 'y': (0, 1)})
+    >>> m.groupdict()
+    {'x': 'two', 'y': 'three'}
+
+    The spans of groups inside sublists are offsets into those sublists.
+    The names of the methods can't be used as the names of groups:
+
+    >>> Pattern('a #span')
+    Traceback (most recent call last):
+        ...
+    ValueError: 'span' can't name a group, as it is a method of match objects
+
+    A match is pickled with the elements it has matched only, rather than
+    with the whole sentence, and keeps its offsets in the sentence:
+
+    >>> import pickle
+    >>> sen = 'one two [three four] five' + ' more' * 10000
+    >>> m = Pattern('two #x [#y four]').search(sen)
+    >>> len(pickle.dumps(m)) < 1000
+    True
+    >>> m = pickle.loads(pickle.dumps(m))
+    >>> m(), m.span(), m.spans(), m.groupdict()
+    ('two [three four]', (1, 3), {'x': (2, 2), 'y': (0, 1)}, {'x': '', 'y': 'three'})
+    """
+    __slots__ = ('_span', '_offset')
+
+    def __init__(self, span, offset=0):
+        # `offset` is that of the text of the span in the sentence, when
+        # it holds only a part of the sentence
+        self._span = span
+        self._offset = offset
+
+    def __reduce__(self):
+        span = self._span
+        return (UserMatch, (rebase(span, span.text),
+                            self._offset + span.start))
+
+    def __call__(self):
+        return str(self._span)
+
+    def __getattr__(self, name):
+        if not name.startswith('_'):
+            try:
+                return str(self._span.groups[name])
+            except KeyError:
+                pass
+        raise AttributeError("the match has no group '{0}'".format(name))
+
+    def span(self):
+        return (self._offset + self._span.start,
+                self._offset + self._span.end)
+
+    def spans(self):
+        # the groups at the top level of the sentence are moved by the
+        # offset, those in sublists are not
+        text = self._span.text
+        spans = {}
+        for (name, group) in self._span.groups.items():
+            offset = self._offset if group.text is text else 0
+            spans[name] = (offset + group.start, offset + group.end)
+        return spans
+
+    def groupdict(self):
+        return {name: str(group)
+                for (name, group) in self._span.groups.items()}
+
+
+# the names of the methods of match objects, which can't name groups
+MATCH_METHODS = frozenset(name for name in vars(UserMatch)
+                          if not name.startswith('_'))
+
+
+class Span:
+    """A matched part text[start:end] of a Text, with the Spans of the
+    named groups in it."""
+    __slots__ = ('text', 'start', 'end', 'groups')
+
+    def __init__(self, text, start, end, groups=None):
+        self.text = text
+        self.start = start
+        self.end = end
+        self.groups = groups
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __str__(self):
+        return str(SList(list(self.text.elems[self.start:self.end])))
+
+
+class Special:
+    from_to = {
+        '?': (0, 1),
+        '!': (1, 1),
+        '#': (0, float('inf')),
+        '&': (1, float('inf'))
+    }
+
+    # the from-to notation
+    curly_mn = re.compile(r"""
+        \{      # Opening curly brace
+        (\d*)   # `from` value (possibly empty)
+        :       # Semicolon
+        (\d*)   # `to` value (possibly empty)
+        \}      # Closing curly brace
+        (.*)    # The rest of the special element: match name and functions
+    """, re.VERBOSE)
+
+    # the n-elements notation
+    curly_n = re.compile(r"""
+        \{      # Opening curly brace
+        (\d+)   # `from` value
+        \}      # Closing curly brace
+        (.*)    # The rest of the special element: match name and functions
+    """, re.VERBOSE)
+
+    params = re.compile(r'([:@])')
+    # used for splitting `params` at colons or at-signs
+
+    def __init__(self, s, slist, registry=None):
+        self.slist = slist
+        self.s = s
+        self.registry = registry
+
+        for metachar in self.from_to:
+            if self.s.startswith(metachar):
+                from_, to = self.from_to[metachar]
+                rest = self.s[1:]
+                break
+        else:
+            # compare the element with the `from-to` notation pattern 
+            m = self.curly_mn.match(self.s)
+            if m:
+                # the `from-to` notation was used
+                # name groups
+                from_ = m.group(1)
+                to = m.group(2)
+                rest = m.group(3)
+
+                # convert `from_` and `to` to numbers (or infinity)
+                if from_:
+                    from_ = int(from_)
+                else:
+                    from_ = 0
+
+                if to:
+                    to = int(to)
+                else:
+                    to = float('inf')
+            else:
+                # compare the element with the `n elements` notation pattern
+                m = self.curly_n.match(self.s)
+                if m:
+                    # the `n elements` notation was used
+                    # name groups
+                    n = m.group(1)
+                    rest = m.group(2)
+                    n = int(n)
+                    from_, to = n, n
+                else:
+                    raise ValueError("The '{0}' element ".format(self.s) + 
+                                     "of the pattern is a string which "
+                                     "starts with a metacharacter -- "
+                                     "? ! # & or { -- but is not "
+                                     "a valid special element.")
+
+        if rest.startswith('?'):
+            self.greedy = False
+            rest = rest[1:]
+        else:
+            self.greedy = True
+
+        # Extract the match name and functions from the special element
+        # string.
+
+        # Create functions lists
+
+        elem_funs = []
+        slice_funs = []
+
+        # Check for functions which require an argument
+        if rest.endswith(':'):
+            # Create a special function using the 'pat's first element
+            elem_funs.append(ArgFunction(self.getarg()))
+            rest = rest[:-1]  # Remove the trailing colon
+        elif rest.endswith('@'):
+            slice_funs.append(ArgFunction(self.getarg()))
+            rest = rest[:-1]
+        elif rest.endswith(':in'):
+            elem_funs.append(self.make_in())
+            rest = rest[:-3]
+        elif rest.endswith(':notin'):
+            elem_funs.append(self.make_notin())
+            rest = rest[:-6]
+        elif rest.endswith('@in'):
+            slice_funs.append(self.make_in())
+            rest = rest[:-3]
+        elif rest.endswith('@notin'):
+            slice_funs.append(self.make_notin())
+            rest = rest[:-6]
+
+        del self.slist
+        # It won't be needed anymore.
+
+        # Split `rest` at colons and at-signs, and preserve those colons
+        # and at-signs as elements in the resulting list.
+        # If `rest` are
+        # 'name:fun1:fun2@fun3@fun4'
+        # then `splitted` will be
+        # ['name', ':', 'fun1', ':', 'fun2', '@', 'fun3', '@', 'fun4']
+        splitted = self.params.split(rest)
+
+        # We are going to pop elements from the start of the list
+        splitted = deque(splitted)
+
+        # Name of the match
+        self.name = splitted.popleft()
+
+        # names of the functions from the 'functions' dictionary
+        self.fun_names = {':': [], '@': []}
+
+        # Extracting functions
+        if not all(splitted):
+            # `splitted` has empty strings as its elements
+            raise ValueError("two delimiters (colon or at-sign) "
+                             "cannot be adjacent")
+
+        while splitted:
+            # At the start of each loop run the length of `splitted` is even
+            symbol = splitted.popleft()
+            fun = splitted.popleft()
+
+            if fun in {'in', 'notin'}:
+                raise ValueError("Functions 'in' and 'nnotin' can only occur "
+                                 "at the end of the special element string "
+                                 "in {0}".format(self.s))
+
+            self.fun_names[symbol].append(fun)
+            if symbol == ":":
+                elem_funs.append(get_function(fun, registry))
+            elif symbol == "@":
+                function = get_function(fun, registry)
+                if isinstance(function, VectorizedFunction):
+                    raise ValueError("the vectorized function '{0}' ".format(
+                                     fun) + "can only follow a colon "
+                                     "in {0}".format(self.s))
+                slice_funs.append(function)
+
+        self.from_, self.to = from_, to
+        self.elem_funs = elem_funs
+        self.slice_funs = slice_funs
+
+        # Reject invalid match names up front rather than at match time
+        if self.name and not is_valid_name(self.name):
+            raise ValueError("'{0}' is not a valid match ".format(self.name) +
+                             "name; presumably it is not alphanumerical"
+                             "or it is a Python keyword")
+        # The groups are attributes of match objects, so they can't be
+        # named after the methods of match objects.
+        if self.name in MATCH_METHODS:
+            raise ValueError("'{0}' can't name a group, as it is a method "
+                             "of match objects".format(self.name))
+
+    def __getstate__(self):
+        # Functions are saved by their names and looked up again when the
+        # special element is loaded, in the registry given to load() or
+        # else in the 'functions' dictionary. The registry itself isn't
+        # saved, as it may hold any number of functions, and functions
+        # which can't be pickled.
+        state = self.__dict__.copy()
+        del state['registry']
+        for (attr, symbol) in [('elem_funs', ':'), ('slice_funs', '@')]:
+            names = iter(self.fun_names[symbol])
+            state[attr] = [fun if isinstance(fun, ArgFunction)
+                           else next(names) for fun in state[attr]]
+        return state
+
+    def __setstate__(self, state):
+        state['registry'] = registry = loading_registry()
+        for attr in ['elem_funs', 'slice_funs']:
+            state[attr] = [get_function(fun, registry)
+                           if isinstance(fun, str) else fun
+                           for fun in state[attr]]
+        self.__dict__.update(state)
+
+    # Functions for creating :in and :notin instances
+    def make_in(self):
+        arg = self.getarg()
+        if not isinstance(arg, list):
+            raise TypeError("the argument to :in must be a list "
+                            "in {0}".format(self.s))
+        return InFunction(arg)
+
+    def make_notin(self):
+        arg = self.getarg()
+        if not isinstance(arg, list):
+            raise TypeError("the argument to :notin must be a list "
+                            "in {0}".format(self.s))
+        return NotInFunction(arg)
+
+    def getarg(self):
+        try:
+            arg = self.slist.pop()
+        except IndexError:
+            raise ValueError("a function in a special element "
+                             "{0} requires an argument".format(self.s))
+        if isinstance(arg, list):
+            return pattern_init(arg, self.registry)
+        else:  # "arg" is a string
+            return arg
+
+    def match(self, pat, sen, toplevel):
+        return SpecialMatching(self, pat, sen, toplevel).go()
+
+
+def get_function(name, registry=None):
+    # the function of the name in the registry, or else in the 'functions'
+    # dictionary
+    if registry is not None:
+        return registry[name]
+    try:
+        return functions[name]
+    except KeyError:
+        raise KeyError("the function name '{0}' is not ".format(name) +
+                       "in the 'functions' dictionary") from None
+
+
+class Registry:
+    """A set of named functions for the special elements of patterns,
+    to use instead of the 'functions' dictionary.
+
+    Patterns compiled with a registry look their functions up in it, and
+    the registry is frozen once the first of them is compiled: functions
+    can no longer be added, so the patterns can be shared between threads
+    and each tenant of a program can have its own functions.
+
+    >>> tenant = Registry({'islower': str.islower})
+    >>> p = Pattern('#x:islower', registry=tenant)
+    >>> p.match('ab cd EF').x
+    'ab cd'
+    >>> tenant.register('isupper', str.isupper)
+    Traceback (most recent call last):
+        ...
+    RuntimeError: the registry is frozen
+    >>> Pattern('#:isupper', registry=tenant)
+    Traceback (most recent call last):
+        ...
+    KeyError: "the function name 'isupper' is not in the registry"
+    """
+    def __init__(self, functions=None):
+        self.functions = dict(functions or {})
+        self.frozen = False
+        self.lock = threading.Lock()
+
+    def register(self, name, fun):
+        with self.lock:
+            if self.frozen:
+                raise RuntimeError("the registry is frozen")
+            self.functions[name] = fun
+
+    def freeze(self):
+        with self.lock:
+            self.frozen = True
+
+    def __getitem__(self, name):
+        try:
+            return self.functions[name]
+        except KeyError:
+            raise KeyError("the function name '{0}' is not ".format(name) +
+                           "in the registry") from None
+
+    def __contains__(self, name):
+        return name in self.functions
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+class SpecialMatching:
+    def __init__(self, special, pat, sen, toplevel):
+        self.__dict__.update(special.__dict__)
+        if self.greedy:
+            self.go = self.greedy1
+        else:
+            self.go = self.nongreedy
+        self.pat = pat.copy()
+        self.sen = deque(sen)
+        self.match = Match(name=self.name)
+        self.toplevel = toplevel
+
+    def greedy1(self):
+        if self.to == 0:
+            # maximal number of elements have been matched, test slices
+            return self.greedy2()
+        if not self.sen:
+            return self.greedy2()
+        # test sen[0] against the functions in elem_funs
+        for fun in self.elem_funs:
+            if not fun(self.sen[0]):
+                # one of the functions evaluated to False
+                return self.greedy2()
+        else:
+            self.from_ -= 1
+            self.to -= 1
+            self.match.append(self.sen.popleft())
+            return self.greedy1()    
+
+    def greedy2(self):
+        if self.from_ > 0:
+            # not enough elements have been matched
+            return None
+        # test the match against the functions in elem_funs
+        slice_rvs = [fun(self.match) for fun in self.slice_funs]
+        if all(slice_rvs):
+            # all functions evaluated to True
+            # compare the remaining part of the pattern with the remaining part
+            # of the sentence
+            m = compare(self.pat, list(self.sen), self.toplevel)
+            if m is not None:
+                # matching successful
+                for rv in slice_rvs:
+                    if isinstance(rv, Match):
+                        self.match.update(rv)
+                return self.match + m
+            else:
+                # move the last element back from 'match' to 'sen'
+                if self.match:
+                    self.from_ += 1
+                    self.sen.appendleft(self.match.pop())
+                    return self.greedy2()
+                else:
+                    return None
+        else:
+            # some of the functions returned evaluated to False
+            # move the last element back from 'match' to 'sen'
+            if self.match:
+                self.from_ += 1
+                self.sen.appendleft(self.match.pop())
+                return self.greedy2()
+            else:
+                return None
+
+    def nongreedy(self):
+        if self.to < 0:
+            return None
+        if not self.sen:
+            return None
+        for fun in self.elem_funs:
+            if not fun(self.sen[0]):
+                return None
+        if self.from_ > 0:
+            self.from_ -= 1
+            self.to -= 1
+            self.match.append(self.sen.popleft())
+            return self.nongreedy()
+        else:
+            slice_rvs = [fun(self.match) for fun in self.slice_funs]
+            if all(slice_rvs):
+                m = compare(self.pat, list(self.sen), self.toplevel)
+                if m is not None:
+                    # matching successful
+                    for rv in slice_rvs:
+                        if isinstance(rv, Match):
+                            self.match.update(rv)
+                    return self.match + m
+                else:
+                    self.from_ -= 1
+                    self.to -= 1
+                    self.match.append(self.sen.popleft())
+                    return self.nongreedy()
+            else:
+                self.from_ -= 1
+                self.to -= 1
+                self.match.append(self.sen.popleft())
+                return self.nongreedy()
+
+
+def compare(pat, sen, toplevel=True):
+    if toplevel:
+        if not pat:
+            return Match()
+        elif isinstance(pat[0], Special):
+            special = pat[0]
+            return special.match(pat[1:], sen, toplevel)
+        elif not sen:
+            return None
+    else:
+        if not pat and not sen:
+            # comparing the pattern has finished successfully
+            return Match()
+        elif not pat:
+            # the pattern and the sentence are of unequal lengths
+            return None
+        elif isinstance(pat[0], Special):
+            special = pat[0]
+            return special.match(pat[1:], sen, toplevel)
+        elif not sen:
+            return None
+
+    # the pattern and the sentence are non-empty
+
+    if isinstance(pat[0], str) and isinstance(sen[0], str):
+    # pat[0] and sen[0] are regular words
+        if pat[0].lower() == sen[0].lower():
+            # pat[0] and sen[0] are equal, case-insentitive;
+            # compare the remaining part of the pattern
+            # and the sentence
+            return Match(sen[0]) + compare(pat[1:], sen[1:], toplevel)
+        else:
+            return None
+    elif isinstance(pat[0], list) and isinstance(sen[0], list):
+        # pat[0] and sen[0] are sublists
+        m = compare(pat[0], sen[0], toplevel=False)
+        if m is not None:
+            # pat[0] and sen[0] match each other;
+            # compare the remaining part of the pattern
+            # and the sentence
+            return m.as_sublist() + \
+                   compare(pat[1:], sen[1:], toplevel)
+        else:
+            return None
+    else:
+        # pat[0] and sen[0] are of different types
+        return None
+
+
+# Built-in functions of special elements. Unlike functions taken from the
+# 'functions' dictionary, they carry their argument as compiled programs,
+# which lets Program test them by offsets instead of by copying slices.
+# The programs are compiled along with the pattern, with its folding.
+
+class ArgFunction:
+    """The special function created by a trailing ':' or '@'.
+
+    The tested element (or slice) must match the argument of the special
+    element, which is either a word or a subpattern.
+    """
+    def __init__(self, arg):
+        self.arg = arg
+
+    def compile(self, folding):
+        self.program = Program(self.arg, folding)
+        # whether a successful test may carry named groups
+        self.groups = bool(self.program.captures)
+
+    def __call__(self, obj):
+        return compare(self.arg, obj, toplevel=False)
+
+    def test(self, text, start, end, tracer=None):
+        return self.program.match(text, start, end, toplevel=False,
+                                  tracer=tracer)
+
+    def test_elem(self, text, i, tracer=None):
+        return self.program.match_elem(text, i, tracer)
+
+
+class InFunction(ArgFunction):
+    """The :in and @in function: some subpattern in the argument list
+    must match the tested element (or slice)."""
+    def compile(self, folding):
+        self.programs = [Program(subpat, folding) for subpat in self.arg]
+        self.groups = any(program.captures for program in self.programs)
+        # A list of words only is tested against single words by looking
+        # the key of the word up in a set.
+        if all(isinstance(subpat, str) for subpat in self.arg):
+            self.words = frozenset(map(folding, self.arg))
+        else:
+            self.words = None
+
+    def __call__(self, obj):
+        for subpat in self.arg:
+            m = compare(subpat, obj, toplevel=False)
+            if m is not None:
+                return m
+        else:
+            return None
+
+    def test(self, text, start, end, tracer=None):
+        for program in self.programs:
+            m = program.match(text, start, end, toplevel=False,
+                              tracer=tracer)
+            if m is not None:
+                return m
+        else:
+            return None
+
+    def test_elem(self, text, i, tracer=None):
+        if self.words is not None and text.sub(i) is None:
+            return True if text.keys[i] in self.words else None
+        for program in self.programs:
+            m = program.match_elem(text, i, tracer)
+            if m is not None:
+                return m
+        else:
+            return None
+
+
+class NotInFunction(InFunction):
+    """The :notin and @notin function: no subpattern in the argument list
+    may match the tested element (or slice)."""
+    def compile(self, folding):
+        super().compile(folding)
+        self.groups = False  # a successful test returns True
+
+    def __call__(self, obj):
+        return super().__call__(obj) is None
+
+    def test(self, text, start, end, tracer=None):
+        return super().test(text, start, end, tracer) is None
+
+    def test_elem(self, text, i, tracer=None):
+        return super().test_elem(text, i, tracer) is None
+
+
+class PureFunction:
+    """A function for the 'functions' dictionary whose result depends on
+    its argument only, so that it is called once for equal arguments.
+
+    The results of the `maxsize` most recently used arguments are kept,
+    across sentences and patterns. Use the pure() function to make one:
+
+    >>> calls = []
+    >>> def short(elem):
+    ...     calls.append(elem)
+    ...     return len(elem) <= 2
+    >>> functions['short'] = pure(short)
+    >>> Pattern('#x:short').findall('an ox is here an ox')[0].x
+    'an ox is'
+    >>> calls
+    ['an', 'ox', 'is', 'here']
+    >>> del functions['short']
+    """
+    def __init__(self, fun, maxsize=4096):
+        self.fun = fun
+        self.maxsize = maxsize
+        self.results = OrderedDict()  # frozen argument -> result
+        self.lock = threading.Lock()
+
+    def __call__(self, obj):
+        key = freeze(obj)
+        with self.lock:
+            try:
+                rv = self.results[key]
+            except KeyError:
+                pass
+            else:
+                self.results.move_to_end(key)
+                return rv
+        rv = self.fun(obj)
+        with self.lock:
+            self.results[key] = rv
+            if len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+        return rv
+
+    def __reduce__(self):
+        # the results stay behind
+        return (PureFunction, (self.fun, self.maxsize))
+
+    def purge(self):
+        with self.lock:
+            self.results.clear()
+
+
+class VectorizedFunction:
+    """An elem function which tests all the elements of a sentence in
+    one call.
+
+    The function is given the list of the elements and returns a boolean
+    mask: a sequence with a true or false value for each of them. It is
+    called once per sentence (and sublist), and matching looks the
+    results up in the mask. Use the vectorized() function to make one:
+
+    >>> calls = []
+    >>> def lowers(elems):
+    ...     calls.append(len(elems))
+    ...     return [isinstance(e, str) and e.islower() for e in elems]
+    >>> functions['islower'] = vectorized(lowers)
+    >>> [m.x for m in Pattern('#x:islower').findall('ab cd EF gh')]
+    ['ab cd', 'cd', '', 'gh', '']
+    >>> calls
+    [4]
+    >>> del functions['islower']
+    """
+    def __init__(self, fun):
+        self.fun = fun
+
+    def __call__(self, obj):
+        # test a single element, as compare() does
+        return self.fun([obj])[0]
+
+    def mask(self, text):
+        mask = text.masks.get(self)
+        if mask is None:
+            mask = text.masks[self] = self.fun(text.elems)
+        return mask
+
+
+def vectorized(fun):
+    """Declare a function vectorized; see VectorizedFunction."""
+    return VectorizedFunction(fun)
+
+
+def pure(fun, maxsize=4096):
+    """Declare a function pure; see PureFunction."""
+    return PureFunction(fun, maxsize)
+
+
+def freeze(obj):
+    # a hashable equivalent of an element or a slice: lists become tuples
+    if isinstance(obj, list):
+        return tuple(map(freeze, obj))
+    return obj
+
+
+def test_elem(fun, text, i, tracer=None):
+    # apply an elem function to the element of the text at `i`
+    if isinstance(fun, ArgFunction):
+        return fun.test_elem(text, i, tracer)
+    elif isinstance(fun, VectorizedFunction):
+        return fun.mask(text)[i]
+    else:
+        return fun(text.elems[i])
+
+
+def test_slice(fun, text, start, end, tracer=None):
+    # apply a slice function to text[start:end] without copying the slice
+    # unless the function comes from the 'functions' dictionary
+    if isinstance(fun, ArgFunction):
+        return fun.test(text, start, end, tracer)
+    else:
+        return fun(list(text.elems[start:end]))
+
+
+class BudgetExceeded(RuntimeError):
+    """Raised when matching takes more steps or time than its Tracer
+    allows. The `tracer` attribute holds the counts up to that point."""
+    def __init__(self, message, tracer):
+        super().__init__(message)
+        self.tracer = tracer
+
+
+class Tracer:
+    """Counts the work done by the matcher, and optionally limits it.
+
+    Pass a tracer to the match(), search(), finditer() or findall() method
+    of a pattern. `steps` counts the elements of patterns compared with
+    elements of the sentence, including those of subpatterns, the numbers
+    of elements special elements try, the elements they test with their
+    functions and the calls of the functions. `backtracks` and `calls`
+    map special elements to the number of times matching has come back to
+    them to try another number of elements, and to the number of calls of
+    their functions.
+
+    >>> functions['islower'] = str.islower
+    >>> p = Pattern('#x:islower b #y@ [# c]')
+    >>> tracer = Tracer()
+    >>> p.match('a b a c', tracer=tracer).y
+    'a c'
+    >>> print(tracer)
+    steps: 25
+    #x:islower  backtracks: 3  calls: 4
+    #           backtracks: 1  calls: 0
+    #y@         backtracks: 0  calls: 1
+
+    The # above is the one in the argument of #y@.
+    >>> del functions['islower']
+
+    With `max_steps` or `timeout` (in seconds), BudgetExceeded is raised
+    when the call has taken more steps or time:
+
+    >>> Pattern('# a # a # a # b').search(['b'] + ['a'] * 50,
+    ...     tracer=Tracer(max_steps=1000))  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    BudgetExceeded: more than 1000 steps
+
+    The calls of functions count, so a slow function can't run past the
+    budget either:
+
+    >>> functions['slow'] = lambda word: time.sleep(0.001) or True
+    >>> Pattern('#x:slow b').search(['a'] * 2000 + ['b'],
+    ...     tracer=Tracer(timeout=0.05))  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+        ...
+    BudgetExceeded: out of time
+    >>> del functions['slow']
+
+    A tracer may be used for several calls; the counts add up, and the
+    limits apply to each call by itself, from when it begins to run. The
+    time a call waits for an executor thread, and the time a finditer()
+    generator waits for its next match to be asked for, don't count:
+
+    >>> tracer = Tracer(timeout=0.05)
+    >>> time.sleep(0.1)
+    >>> print(Pattern('# a # a # b').search(['b'] + ['a'] * 50,
+    ...                                     tracer=tracer))
+    None
+    >>> tracer.steps > Tracer.clock_interval
+    True
+    """
+    # the time is checked once per this many steps
+    clock_interval = 64
+
+    def __init__(self, max_steps=None, timeout=None):
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.steps = 0
+        self.backtracks = Counter()  # special element -> backtracks
+        self.calls = Counter()  # special element -> function calls
+        self.start()
+
+    def start(self):
+        # begin the budget of a call: the limits apply to the steps and
+        # the time from here on
+        if self.max_steps is not None:
+            self.limit = self.steps + self.max_steps
+        else:
+            self.limit = None
+        self.spent = 0.0  # seconds, up to when the clock last stopped
+        self.resume()
+
+    def pause(self):
+        # stop the clock of the call
+        self.spent += time.perf_counter() - self.resumed
+
+    def resume(self):
+        self.resumed = time.perf_counter()
+
+    def step(self):
+        self.steps += 1
+        if self.limit is not None and self.steps > self.limit:
+            raise BudgetExceeded("more than {0} steps".format(self.max_steps),
+                                 self)
+        if (self.timeout is not None and
+                self.steps % self.clock_interval == 0 and
+                self.spent + time.perf_counter() - self.resumed >
+                self.timeout):
+            raise BudgetExceeded("out of time", self)
+
+    def __str__(self):
+        # the counts of the special elements, the most active first, and
+        # those as active in the order they were first counted
+        specials = sorted(dict.fromkeys([*self.backtracks, *self.calls]),
+                          key=lambda s: -(self.backtracks[s] + self.calls[s]))
+        width = max([len(special.s) for special in specials], default=0)
+        lines = ['steps: {0}'.format(self.steps)]
+        for special in specials:
+            lines.append('{0:<{1}}  backtracks: {2}  calls: {3}'.format(
+                special.s, width, self.backtracks[special],
+                self.calls[special]))
+        return '\n'.join(lines)
+
+
+# The ways of comparing the words of patterns and sentences: both are
+# folded with the function before they are compared.
+cases = {
+    'lower': str.lower,
+    'casefold': str.casefold,
+    'exact': str
+}
+
+
+class Folding:
+    """Turns words into the keys compiled patterns compare: the words
+    folded with the function of the case and interned."""
+    def __init__(self, case, fold):
+        self.case = case
+        self.fold = fold
+
+    def __call__(self, word):
+        return intern(self.fold(word))
+
+    def __reduce__(self):
+        # unpickle as the shared Folding of the case
+        return (get_folding, (self.case,))
+
+    def text(self, sen, tokenizer=None):
+        return Text(tokens(sen, tokenizer), self)
+
+
+foldings = {}  # case name -> Folding
+
+
+def get_folding(case):
+    try:
+        fold = cases[case]
+    except KeyError:
+        raise ValueError("'{0}' is not a case; it must be ".format(case) +
+                         "one of: " + ", ".join(cases)) from None
+    folding = foldings.get(case)
+    if folding is None or folding.fold is not fold:
+        folding = foldings[case] = Folding(case, fold)
+    return folding
+
+
+def tokens(sen, tokenizer=None):
+    """Return the elements of a sentence, as matching takes them.
+
+    A tuple is taken to be split into words already, and is used as it
+    is, without being copied: its words must be strings, and its sublists
+    tuples (or lists) of the same kind. A string is split by `tokenizer`
+    if one is given, and whatever sequence it returns is used as it is;
+    otherwise, the string and lists are converted to a SList.
+
+    >>> sen = ('one', ('two', 'three'))
+    >>> tokens(sen) is sen
+    True
+    >>> tokens('one [two three]')
+    ['one', ['two', 'three']]
+    >>> tokens('He said: go', punctuation)
+    ['He', 'said', ':', 'go']
+    """
+    if isinstance(sen, tuple):
+        return sen
+    if tokenizer is not None and isinstance(sen, str):
+        return tokenizer(sen)
+    return SList(sen)
+
+
+class Tokenizer:
+    """Splits strings into the words a regular expression finds in them.
+
+    The default way of splitting sentences, SList, splits them at spaces,
+    so that punctuation stays attached to words, and reads square brackets
+    as sublists. A Tokenizer given to Pattern or PatternSet splits the
+    sentences given as strings instead; it has no sublists.
+
+    >>> p = Pattern('#? voice : #x', tokenizer=punctuation)
+    >>> p.match('in a low voice: "Come in."').x
+    '" Come in . "'
+
+    Tokenizers of the same regular expression and flags are equal, so a
+    pattern loaded from a file or sent to a worker goes with the indexes
+    and the patterns made with the tokenizer it was compiled with:
+
+    >>> pickle.loads(pickle.dumps(p)).tokenizer == punctuation
+    True
+    """
+    def __init__(self, regex, flags=0):
+        self.regex = re.compile(regex, flags)
+
+    def __call__(self, sen):
+        return self.regex.findall(sen)
+
+    def __eq__(self, other):
+        if not isinstance(other, Tokenizer):
+            return NotImplemented
+        return (self.regex.pattern, self.regex.flags) == \
+            (other.regex.pattern, other.regex.flags)
+
+    def __hash__(self):
+        return hash((self.regex.pattern, self.regex.flags))
+
+
+# words, which may be joined by apostrophes or hyphens, and single marks
+punctuation = Tokenizer(r"\w+(?:['’-]\w+)*|[^\w\s]")
+
+
+class Text:
+    """A sentence prepared for matching by compiled patterns.
+
+    `elems` are the elements of the sentence as given; they are what
+    functions are called with and what matches are made of. `keys` are
+    what the words of patterns are compared with: the words of the
+    sentence folded and interned, and sublists as Text objects of their
+    own. The folding is done once per sentence, so comparing two words is
+    a plain comparison of interned strings.
+
+    >>> t = Text(SList('The [Cat]'))
+    >>> t.keys[0], t.keys[1].keys
+    ('the', ['cat'])
+    >>> Text(['The'], get_folding('exact')).keys
+    ['The']
+    """
+    def __init__(self, sen, folding=None):
+        if folding is None:
+            folding = get_folding('lower')
+        self.elems = sen
+        self.keys = [folding(elem) if isinstance(elem, str)
+                     else Text(elem, folding) for elem in sen]
+        self.tested = {}  # special element -> {position: elem_ok}
+        self.masks = {}  # VectorizedFunction -> its mask of the elements
+
+    def __len__(self):
+        return len(self.elems)
+
+    def sub(self, i):
+        # the Text of the element at `i` if it is a sublist, or None
+        key = self.keys[i]
+        return key if isinstance(key, Text) else None
+
+
+class Vocabulary:
+    """Interns words to integer ids.
+
+    A vocabulary stores sentences compactly, as EncodedSentences, and
+    patterns compiled with it compare word ids instead of strings. Every
+    word gets an id, and so does its folded form; words are compared by
+    the ids of their folded forms. Id 0 stands for sublists.
+
+    >>> v = Vocabulary()
+    >>> enc = v.encode('The cat [sat on] the mat')
+    >>> enc.ids
+    array('i', [1, 3, 0, 2, 4])
+    >>> print(v.decode(enc))
+    The cat [sat on] the mat
+    >>> p = Pattern('the #x [sat #] the #y', vocabulary=v)
+    >>> m = p.match(enc)
+    >>> m.x, m.y
+    ('cat', 'mat')
+
+    Patterns compiled with a vocabulary match plain sentences as well.
+    Only encode() and the compiling of patterns add words to the
+    vocabulary; the words of plain sentences are looked up, and those it
+    doesn't have, which can't be words of the patterns, get the key
+    UNKNOWN:
+
+    >>> p.match('the dog [sat down] the rug').y
+    'rug'
+    >>> len(v), v('dog')
+    (6, -1)
+
+    The words a pattern starts with, which searches skip to, are ids too,
+    and are found in the arrays of ids of EncodedSentences:
+
+    >>> q = Pattern('the cat #', vocabulary=v)
+    >>> q.program.prefix == [v('the'), v('cat')]
+    True
+    >>> q.program.next_start(v.text(v.encode('and the cat')).keys, 0, 3)
+    1
+
+    A vocabulary has a unique `uid`, and a process has one copy of it at
+    most: a vocabulary unpickled where a copy of it is already is that
+    copy, with the words it lacks added. EncodedSentences are pickled
+    without their vocabulary, and unpickled with the copy of it in the
+    process, so a sentence sent to a worker which has a pattern compiled
+    with the vocabulary can be matched by the pattern there.
+    """
+    def __init__(self, case='lower'):
+        self.fold = get_folding(case).fold
+        self.words = [None]  # id -> word
+        self.ids = {}  # word -> id
+        self.folded = array('i', [SUBLIST])  # id -> id of the folded word
+        self.lock = threading.Lock()
+        self.uid = uuid.uuid4().hex
+        vocabularies[self.uid] = self
+
+    def __reduce__(self):
+        with self.lock:
+            return (get_vocabulary, (self.uid, self.fold, self.words[1:],
+                                     self.folded[1:]))
+
+    def __len__(self):
+        return len(self.words) - 1
+
+    def id(self, word):
+        """Return the id of the word, giving it one if it has none."""
+        i = self.ids.get(word)
+        if i is None:
+            with self.lock:
+                i = self.add(word)
+        return i
+
+    def add(self, word):
+        # give the word an id, with the lock held; the word goes in `ids`
+        # last, so that threads which look words up without the lock see
+        # only complete entries
+        i = self.ids.get(word)
+        if i is None:
+            i = len(self.words)
+            self.words.append(word)
+            self.folded.append(i)
+            folded = self.fold(word)
+            if folded != word:
+                self.folded[i] = self.add(folded)
+            self.ids[word] = i
+        return i
+
+    def since(self, start):
+        # the words with ids from `start` on, and the ids of their folded
+        # forms, for extend()
+        with self.lock:
+            return start, self.words[start:], self.folded[start:]
+
+    def extend(self, start, words, folded):
+        # add the words which another copy of the vocabulary has given the
+        # ids from `start` on, and which this copy doesn't have yet
+        with self.lock:
+            for (i, word) in enumerate(words, start):
+                if i == len(self.words):
+                    self.words.append(word)
+                    self.folded.append(folded[i - start])
+                    self.ids[word] = i
+
+    def __call__(self, word):
+        # the key of a word of a sentence, for compiled patterns: the id of
+        # its folded form, or UNKNOWN
+        i = self.ids.get(word)
+        if i is None:
+            i = self.ids.get(self.fold(word))
+            if i is None:
+                return UNKNOWN
+        return self.folded[i]
+
+    def encode(self, sen):
+        """Return the EncodedSentence of a sentence given as a string or
+        a list."""
+        if not isinstance(sen, SList):
+            sen = SList(sen)
+        ids = array('i', [self.id(elem) if isinstance(elem, str) else SUBLIST
+                          for elem in sen])
+        subs = tuple(self.encode(elem) for elem in sen
+                     if isinstance(elem, list))
+        return EncodedSentence(self, ids, subs)
+
+    def decode(self, sentence):
+        """Return the SList of an EncodedSentence."""
+        subs = iter(sentence.subs)
+        return SList([self.words[i] if i != SUBLIST
+                      else self.decode(next(subs)) for i in sentence.ids])
+
+    def text(self, sen, tokenizer=None):
+        # Besides sentences, an array or a memoryview of the ids of words
+        # is taken as an EncodedSentence without sublists, without copying
+        # it.
+        if isinstance(sen, (array, memoryview)):
+            if SUBLIST in sen:
+                raise ValueError("a sentence given as an array of word ids "
+                                 "can't have sublists")
+            sen = EncodedSentence(self, sen)
+        if isinstance(sen, EncodedSentence):
+            if sen.vocabulary is not self:
+                raise ValueError("the sentence was encoded with another "
+                                 "vocabulary")
+            return EncodedText(sen)
+        return Text(tokens(sen, tokenizer), self)
+
+
+SUBLIST = 0  # the word id standing for sublists
+UNKNOWN = -1  # the key of words a Vocabulary doesn't have
+
+# the vocabularies of the process, by their uids
+vocabularies = weakref.WeakValueDictionary()
+vocabularies_lock = threading.Lock()
+
+
+def get_vocabulary(uid, fold, words, folded):
+    # unpickle a vocabulary as the copy of it in the process, if any
+    with vocabularies_lock:
+        vocabulary = vocabularies.get(uid)
+        if vocabulary is None:
+            vocabulary = Vocabulary.__new__(Vocabulary)
+            vocabulary.fold = fold
+            vocabulary.words = [None]
+            vocabulary.ids = {}
+            vocabulary.folded = array('i', [SUBLIST])
+            vocabulary.lock = threading.Lock()
+            vocabulary.uid = uid
+            vocabularies[uid] = vocabulary
+    vocabulary.extend(1, words, folded)
+    return vocabulary
+
+
+def get_sentence(uid, ids, subs):
+    # unpickle an EncodedSentence with the copy of its vocabulary in the
+    # process
+    vocabulary = vocabularies.get(uid)
+    if vocabulary is None:
+        raise ValueError("the vocabulary the sentence was encoded with "
+                         "hasn't been loaded")
+    return EncodedSentence(vocabulary, ids, subs)
+
+
+class EncodedSentence:
+    """A sentence stored as an array of word ids.
+
+    `ids` holds the ids of the elements of the sentence, with SUBLIST in
+    place of sublists, and `subs` holds the EncodedSentences of the
+    sublists in their order. A sentence takes one machine integer per
+    word instead of one reference to a string object.
+    """
+    __slots__ = ('vocabulary', 'ids', 'subs')
+
+    def __init__(self, vocabulary, ids, subs=()):
+        self.vocabulary = vocabulary
+        self.ids = ids
+        self.subs = subs
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __str__(self):
+        return str(self.vocabulary.decode(self))
+
+    def __reduce__(self):
+        return (get_sentence, (self.vocabulary.uid, array('i', self.ids),
+                               self.subs))
+
+
+class EncodedText:
+    """Text of an EncodedSentence: its keys are the ids of the folded
+    words, and its elements are decoded only when a function or a match
+    needs them."""
+    def __init__(self, sentence):
+        self.sentence = sentence
+        self.keys = array('i', map(sentence.vocabulary.folded.__getitem__,
+                                   sentence.ids))
+        self.subs = {}  # position -> EncodedSentence, then EncodedText
+        i = -1
+        for sub in sentence.subs:
+            i = sentence.ids.index(SUBLIST, i + 1)
+            self.subs[i] = sub
+        self._elems = None
+        self.tested = {}
+        self.masks = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def elems(self):
+        if self._elems is None:
+            self._elems = self.sentence.vocabulary.decode(self.sentence)
+        return self._elems
+
+    def sub(self, i):
+        sub = self.subs.get(i)
+        if isinstance(sub, EncodedSentence):
+            sub = self.subs[i] = EncodedText(sub)
+        return sub
+
+
+class Program:
+    """Compiled form of a pattern.
+
+    Literal words are turned into keys by `folding` once, and sublists
+    are compiled recursively. Matching walks the pattern and a Text of the
+    sentence by integer offsets, so no partial copies of either are made
+    while searching; the result is a Span, built once a match has been
+    found. With the default folding, the results are the same as those of
+    compare():
+
+    >>> def show(span):
+    ...     if span is not None:
+    ...         return (str(span), UserMatch(span).groupdict())
+    >>> def show_ref(m):
+    ...     if m is not None:
+    ...         return (str(SList(m)), {name: str(SList(value))
+    ...                                 for (name, value) in vars(m).items()})
+    >>> sen = SList('one Two [three four] five')
+    >>> for s in ['one # five', '#x [#y four] !', '#? two', 'one &?',
+    ...           '!:in [one two] # five', '&x@ [# [three #y]]']:
+    ...     p = Pattern(s)
+    ...     m, ref = p.program.match(Text(sen), 0, len(sen)), compare(p, sen)
+    ...     print(show(m) == show_ref(ref), show(m))
+    True ('one Two [three four] five', {})
+    True ('one Two [three four] five', {'x': 'one Two', 'y': 'three'})
+    True ('one Two', {})
+    True ('one Two', {})
+    True ('one Two [three four] five', {})
+    True ('one Two [three four]', {'x': 'one Two [three four]', 'y': 'four'})
+
+    So they are for random patterns and sentences, with nested sublists,
+    ':' and '@' arguments, :in and :notin lists, greedy and non-greedy
+    bounds and user functions, matched at every offset:
+
+    >>> import random
+    >>> functions.update(islower=str.islower, short=lambda s: len(s) <= 2)
+    >>> def pattern(r, depth):
+    ...     elems = []
+    ...     for _ in range(r.randint(0, 4 - depth)):
+    ...         kind = r.random()
+    ...         if kind < 0.4:
+    ...             elems.append(r.choice(['a', 'b', 'A']))
+    ...         elif kind < 0.5 and depth < 2:
+    ...             elems.append('[' + pattern(r, depth + 1) + ']')
+    ...         else:
+    ...             elems.append(special(r, depth))
+    ...     return ' '.join(elems)
+    >>> def special(r, depth):
+    ...     s = r.choice(['#', '&', '?', '!', '{2}', '{1:2}', '{:1}', '{2:}'])
+    ...     s += r.choice(['', '?']) + r.choice(['', '', 'x', 'y'])
+    ...     funs = [':islower', '@short', ': a', ':in [a b]', ':notin [b]']
+    ...     if depth < 2:
+    ...         sub = pattern(r, depth + 1)
+    ...         funs += ['@ [{0}]'.format(sub), ': [{0}]'.format(sub),
+    ...                  '@in [[{0}] [a]]'.format(sub)]
+    ...     return s + r.choice([''] * 4 + funs)
+    >>> def sentence(r, depth):
+    ...     return ' '.join('[' + sentence(r, depth + 1) + ']'
+    ...                     if r.random() < 0.15 and depth < 2
+    ...                     else r.choice(['a', 'b', 'A', 'c'])
+    ...                     for _ in range(r.randint(0, 7 - 2 * depth)))
+    >>> def outcome(fun, *args):
+    ...     try:
+    ...         return fun(*args)
+    ...     except (ValueError, TypeError) as e:
+    ...         return type(e)
+    >>> r = random.Random(0)
+    >>> cases = differences = 0
+    >>> for _ in range(600):
+    ...     s, sen = pattern(r, 0), SList(sentence(r, 0))
+    ...     try:
+    ...         p = Pattern(s)
+    ...     except (ValueError, TypeError):
+    ...         continue
+    ...     text = Text(sen)
+    ...     for i in range(len(sen) + 1):
+    ...         cases += 1
+    ...         ref = outcome(lambda: show_ref(compare(p, sen[i:])))
+    ...         m = outcome(lambda: show(p.program.match(text, i, len(sen))))
+    ...         differences += m != ref
+    >>> cases > 2000, differences
+    (True, 0)
+    >>> del functions['islower'], functions['short']
+    """
+    def __init__(self, pat, folding=None):
+        if folding is None:
+            folding = get_folding('lower')
+        self.folding = folding
+        if isinstance(folding, Vocabulary):
+            # the words of patterns get ids, while those of sentences are
+            # only looked up
+            for word in pat:
+                if isinstance(word, str):
+                    folding.id(word)
+            if isinstance(pat, str):
+                folding.id(pat)
+        nodes = []
+        for elem in pat:
+            if isinstance(elem, Special):
+                for fun in elem.elem_funs + elem.slice_funs:
+                    if isinstance(fun, ArgFunction):
+                        fun.compile(folding)
+                nodes.append(elem)
+            elif isinstance(elem, list):
+                nodes.append(Program(elem, folding))
+            else:  # elem is a regular word
+                nodes.append(folding(elem))
+        self.nodes = tuple(nodes)
+
+        # The nodes a match takes named groups from: the named special
+        # elements, the special elements whose slice functions return
+        # matches with groups, and the sublists with groups. Only their
+        # captures are kept, and building a match visits only them.
+        self.captures = tuple(
+            k for (k, node) in enumerate(self.nodes)
+            if isinstance(node, Special) and (node.name or any(
+                getattr(fun, 'groups', False) for fun in node.slice_funs))
+            or isinstance(node, Program) and node.captures)
+
+        # A pattern given as a string is compared with a sublist character
+        # by character, like compare() does, but with a word as a whole.
+        self.word = folding(pat) if isinstance(pat, str) else None
+
+        # The regular words the pattern starts with, and the Horspool skip
+        # table which lets finditer() jump between the places where they
+        # occur in the sentence instead of trying every offset.
+        prefix = []
+        for node in self.nodes:
+            if isinstance(node, (Special, Program)):
+                break
+            prefix.append(node)
+        self.prefix = prefix
+        self.skip = {word: len(prefix) - 1 - j
+                     for (j, word) in enumerate(prefix[:-1])}
+
+        # the least and the greatest number of elements a match may take
+        self.min_width = sum(node.from_ if isinstance(node, Special) else 1
+                             for node in self.nodes)
+        self.width = sum(node.to if isinstance(node, Special) else 1
+                         for node in self.nodes)
+
+        # the keys of the regular words every match contains
+        self.literals = frozenset(node for node in self.nodes
+                                  if not isinstance(node, (Special, Program)))
+
+    def match(self, text, start, end, toplevel=True, index=0, failed=None,
+              tracer=None):
+        """Compare the pattern, from its node at `index` on, against
+        text[start:end].
+
+        If `toplevel` is true, the pattern may match any prefix of the
+        slice; otherwise it must match the whole slice. Return the Span of
+        the match or None.
+
+        `failed` is the memo table of (node index, position) pairs from
+        which the rest of the pattern is known not to match. It may be
+        shared between calls with the same `text`, `end` and `toplevel`.
+        `tracer` is the Tracer of the call, or None.
+
+        The matching is iterative: every special element on the current
+        path keeps a choice point on an explicit stack, and a failure
+        resumes the most recent one with its next number of elements. The
+        memory used is proportional to the length of the pattern, not of
+        the sentence, so there is no limit on the sentence length:
+
+        >>> m = Pattern('a #x b').match(['a'] + ['w'] * 100000 + ['b'])
+        >>> len(m.x.split())
+        100000
+
+        When a choice point runs out of numbers to try, its node index and
+        position go to `failed`, and the path is cut short whenever it
+        reaches them again. The number of elements a special element takes
+        is local to its choice point, so that pair is the whole key. Each
+        special element is therefore expanded at most once per position,
+        which keeps stacked quantifiers polynomial:
+
+        >>> Pattern('# a # a # a # a # b').match(['b'] + ['a'] * 300) is None
+        True
+        """
+        if not (toplevel or index or
+                self.min_width <= end - start <= self.width):
+            # the slice is too short or too long to be matched whole
+            return None
+        if failed is None:
+            failed = set()
+        nodes = self.nodes
+        keys = text.keys
+        captures = self.captures
+        # The capture array: the slice text[caps[2k]:caps[2k + 1]] taken by
+        # the node k on the current path. The end of a special element is
+        # None until its choice point picks the first number of elements.
+        # A node which is reached again overwrites its own entries, so
+        # backtracking restores nothing.
+        caps = [None] * (2 * len(nodes))
+        inner = {}  # capturing node index -> the inner matches it took
+        stack = []  # choice points: indices of special elements
+        k, i = index, start
+
+        while True:
+            if k == len(nodes):
+                if toplevel or i == end:
+                    return self.build(text, start, i, index, caps, inner)
+                # the pattern and the sentence are of unequal lengths
+                ok = False
+            else:
+                if tracer is not None:
+                    tracer.step()
+                node = nodes[k]
+                caps[2 * k] = i
+                if isinstance(node, Special):
+                    # open a choice point, unless the rest of the pattern
+                    # is already known to fail from here; its first number
+                    # of elements is picked below
+                    if (k, i) not in failed:
+                        caps[2 * k + 1] = None
+                        stack.append(k)
+                    ok = False
+                elif i == end:
+                    ok = False
+                elif isinstance(node, Program):
+                    sub = text.sub(i)
+                    m = None
+                    if sub is not None:
+                        m = node.match(sub, 0, len(sub), toplevel=False,
+                                       tracer=tracer)
+                    ok = m is not None
+                    if ok and k in captures:
+                        inner[k] = m
+                else:
+                    # the keys of sublists never equal those of words
+                    ok = keys[i] == node
+                if ok:
+                    k, i = k + 1, i + 1
+                    continue
+
+            # backtrack: resume the most recent choice point which still
+            # has a number of elements left to try
+            while stack:
+                k = stack[-1]
+                i, previous = caps[2 * k], caps[2 * k + 1]
+                if previous is not None:
+                    previous -= i
+                    if tracer is not None:
+                        tracer.backtracks[nodes[k]] += 1
+                if tracer is not None:
+                    tracer.step()
+                n = self.next_count(nodes[k], text, i, end, previous, tracer)
+                if n is not None:
+                    n, slice_rvs = n
+                    caps[2 * k + 1] = i + n
+                    if k in captures:
+                        inner[k] = slice_rvs
+                    k, i = k + 1, i + n
+                    break
+                stack.pop()
+                failed.add((k, i))
+            else:
+                return None
+
+    def match_elem(self, text, i, tracer=None):
+        # Compare the pattern with the single element of the text at `i`.
+        # Return None if they don't match.
+        sub = text.sub(i)
+        if sub is not None:
+            return self.match(sub, 0, len(sub), toplevel=False,
+                              tracer=tracer)
+        elif self.word is not None:
+            return True if text.keys[i] == self.word else None
+        else:
+            # like compare(), match a subpattern against the characters
+            # of the word
+            chars = Text(text.elems[i], self.folding)
+            return self.match(chars, 0, len(chars), toplevel=False,
+                              tracer=tracer)
+
+    def finditer(self, text, overlapped=True, tracer=None):
+        """Generate the Spans of the matches of the pattern in the text,
+        in the order of their start offsets.
+
+        All the attempts share one memo table, so a special element is
+        expanded at most once per position over the whole scan, and only
+        the offsets where the leading regular words of the pattern occur
+        are tried at all. Unless `overlapped` is true, the next attempt
+        starts where the previous match has ended.
+
+        >>> p = Pattern('a #x')
+        >>> text = Text(SList('a b a c'))
+        >>> [(str(m), str(m.groups['x'])) for m in p.program.finditer(text)]
+        [('a b a c', 'b a c'), ('a c', 'c')]
+        >>> [str(m) for m in p.program.finditer(text, False)]
+        ['a b a c']
+        """
+        end = len(text)
+        keys = text.keys
+        if self.rejects(text):
+            return
+        failed = set()
+        i = self.next_start(keys, 0, end)
+        while i is not None:
+            m = self.match(text, i, end, failed=failed, tracer=tracer)
+            if m is None or overlapped:
+                i += 1
+            else:
+                # an empty match is followed by the next offset
+                i += max(len(m), 1)
+            if m is not None:
+                yield m
+            i = self.next_start(keys, i, end)
+
+    def stream(self, tokens, overlapped=True):
+        # Generate the (offset, Span) pairs of the matches in a stream of
+        # tokens; see Pattern.stream(). A match at i is decided by the
+        # tokens up to i + width: a greedy element never looks further,
+        # and a non-greedy one needs one element after its slice. The
+        # tokens are added to a Text one at a time, and each offset is
+        # searched like finditer() does as soon as the tokens after it
+        # fill a window. The tokens before the next offset are dropped
+        # once they are as many as a window.
+        window = self.width + 1
+        text = self.folding.text([])
+        base = 0  # the offset of text[0] in the stream
+        i = 0  # the next offset to try, in the text
+        # The memo of failures is kept while the text grows: an offset is
+        # tried once its window is read, and no match from it looks past
+        # the window, so the tokens added later change none of them.
+        failed = set()
+        tokens = iter(tokens)
+        while True:
+            token = next(tokens, None)
+            last = token is None  # the stream has ended
+            if not last:
+                if isinstance(token, str):
+                    text.elems.append(token)
+                    text.keys.append(self.folding(token))
+                else:
+                    new = self.folding.text([token])
+                    text.elems.extend(new.elems)
+                    text.keys.extend(new.keys)
+                # the masks are those of the shorter text
+                text.masks.clear()
+            end = len(text)
+            # the offsets below `limit` are decided
+            limit = end + 1 if last else end - window + 1
+            while i < limit:
+                start = self.next_start(text.keys, i, end)
+                if start is None:
+                    # the prefix of the pattern may still start where
+                    # too few tokens are left for it
+                    i = max(i, end - len(self.prefix) + 1)
+                    break
+                i = start
+                if i >= limit:
+                    break
+                m = self.match(text, i, end, failed=failed)
+                if m is None or overlapped:
+                    i += 1
+                else:
+                    i += max(len(m), 1)
+                if m is not None:
+                    yield base + m.start, rebase(m, text)
+            if last:
+                return
+            if i >= window:
+                del text.elems[:i]
+                del text.keys[:i]
+                # the memos are kept by position
+                text.tested.clear()
+                text.masks.clear()
+                failed.clear()
+                base += i
+                i = 0
+
+    def rejects(self, text):
+        # Return True if the text is certain not to contain a match: it is
+        # shorter than any match, or lacks one of the regular words. The
+        # test takes at most one pass over the keys of the text.
+        if len(text) < self.min_width:
+            return True
+        if self.literals:
+            return not self.literals.issubset(text.keys)
+        return False
+
+    def next_start(self, keys, i, end):
+        # Return the first offset from `i` on at which the sentence, given
+        # by its keys, starts with the prefix of the pattern,
+        # or None. The search moves along the sentence by the shifts of
+        # the Horspool skip table.
+        n = len(self.prefix)
+        if not n:
+            return i if i <= end else None
+        last = self.prefix[-1]
+        while i + n <= end:
+            key = keys[i + n - 1]
+            # the keys may be an array of word ids, which is never equal
+            # to a list
+            if key == last and all(keys[i + j] == word
+                                   for (j, word) in enumerate(self.prefix)):
+                return i
+            i += self.skip.get(key, n)
+        return None
+
+    def next_count(self, special, text, start, end, previous, tracer=None):
+        # Return the next (number of elements, slice function results)
+        # pair the special element at text[start] may take, or None.
+        # `previous` is the number it has taken last, or None.
+        # Greedy elements try the numbers from the largest downwards,
+        # non-greedy ones from the smallest upwards. Like SpecialMatching,
+        # a non-greedy element tests the element following its slice with
+        # elem functions and needs that element to exist.
+        # The results of the elem functions are memoized per position in
+        # the text, as every choice point of the element tests them anew.
+        # Every element tested and every call of a function is a step of
+        # the tracer.
+        if special.elem_funs:
+            tested = text.tested.get(special)
+            if tested is None:
+                tested = text.tested[special] = {}
+
+            def elem_ok(i):
+                if tracer is not None:
+                    tracer.step()
+                ok = tested.get(i)
+                if ok is None:
+                    ok = True
+                    for fun in special.elem_funs:
+                        if tracer is not None:
+                            tracer.calls[special] += 1
+                            tracer.step()
+                        if not test_elem(fun, text, i, tracer):
+                            ok = False
+                            break
+                    tested[i] = ok
+                return ok
+        else:
+            def elem_ok(i):
+                return True
+
+        if special.greedy:
+            if previous is None and not special.elem_funs:
+                # all the elements up to the end may be taken
+                n = min(special.to, end - start)
+            elif previous is None:
+                n = 0
+                while (n < special.to and start + n < end
+                       and elem_ok(start + n)):
+                    n += 1
+            else:
+                n = previous - 1
+            while n >= special.from_:
+                slice_rvs = [self.call_slice(special, fun, text, start,
+                                             start + n, tracer)
+                             for fun in special.slice_funs]
+                if all(slice_rvs):
+                    return n, slice_rvs
+                n -= 1
+        else:
+            if previous is None:
+                n = 0
+                while n < special.from_:
+                    if not (start + n < end and elem_ok(start + n)):
+                        return None
+                    n += 1
+            else:
+                n = previous + 1
+            while n <= special.to and start + n < end and elem_ok(start + n):
+                slice_rvs = [self.call_slice(special, fun, text, start,
+                                             start + n, tracer)
+                             for fun in special.slice_funs]
+                if all(slice_rvs):
+                    return n, slice_rvs
+                n += 1
+        return None
+
+    def call_slice(self, special, fun, text, start, end, tracer):
+        # apply a slice function of the special element, as a step
+        if tracer is not None:
+            tracer.calls[special] += 1
+            tracer.step()
+        return test_slice(fun, text, start, end, tracer)
+
+    def build(self, text, start, stop, index, caps, inner):
+        # build the Span of text[start:stop] from the capture array of the
+        # path that has matched, visiting the capturing nodes only; later
+        # groups override earlier ones, as they do when compare() adds
+        # Match objects together
+        groups = {}
+        for k in self.captures:
+            if k < index:
+                continue
+            node = self.nodes[k]
+            if isinstance(node, Special):
+                if node.name:
+                    groups[node.name] = Span(text, caps[2 * k],
+                                             caps[2 * k + 1])
+                for rv in inner[k]:
+                    if isinstance(rv, Span):
+                        groups.update(rv.groups)
+            else:
+                groups.update(inner[k].groups)
+        return Span(text, start, stop, groups)
+
+
+def rebase(span, text):
+    # Return the Span of a match in the text as a Span of its own
+    # elements, with the groups at the top level of the text moved by
+    # the offset of the match, and the groups in sublists moved to the
+    # sublists of the new text; the text may then be dropped.
+    start = span.start
+    own = Text(text.elems[start:span.end], get_folding('exact'))
+    subs = {}  # id of a sublist of the text -> its Text in `own`
+    if any(group.text is not text for group in span.groups.values()):
+        pairs = [(text, own, start, span.end)]
+        while pairs:
+            (old, new, low, high) = pairs.pop()
+            for i in range(low, high):
+                sub = old.sub(i)
+                if sub is not None:
+                    subs[id(sub)] = new.sub(i - low)
+                    pairs.append((sub, subs[id(sub)], 0, len(sub)))
+    groups = {}
+    for (name, group) in span.groups.items():
+        if group.text is text:
+            groups[name] = Span(own, group.start - start, group.end - start)
+        else:
+            groups[name] = Span(subs.get(id(group.text), group.text),
+                                group.start, group.end)
+    return Span(own, 0, len(span), groups)
+
+
+class Incremental:
+    """The matches of a pattern in a sentence which is being edited.
+
+    The sentence is given as Pattern.match takes it, and so are the
+    elements an edit puts in. The matches are (offset, match) pairs, as
+    Pattern.stream generates them: those finditer() finds in the current
+    sentence, with `overlapped` as it takes it.
+
+    >>> inc = Incremental(Pattern('the {1:2}x cat'), 'the cat sat')
+    >>> inc.insert(1, 'black')
+    >>> [(offset, m.x) for (offset, m) in inc.matches()]
+    [(0, 'black')]
+    >>> inc.replace(3, 3, 'near the big fat cat')
+    >>> [(offset, m()) for (offset, m) in inc.matches()]
+    [(0, 'the black cat'), (4, 'the big fat cat')]
+    >>> inc.delete(0, 4)
+    >>> print(inc, inc.matches()[0][0])
+    the big fat cat sat 0
+
+    The result of the pattern at every offset of the sentence is kept.
+    A match at an offset depends on the elements from there on, and no
+    further than the greatest width of a match, so an edit only matches
+    the pattern again at the offsets of the new elements and at those
+    less than that width before them; the results at the other offsets
+    are kept, and moved by the edit. If the pattern has a # or &
+    element, the width has no bound, and the offsets before the edit
+    are all matched again.
+
+    The matches are kept as Spans of the sentence being edited, which
+    take no copy of the elements; the match objects matches() returns
+    have their own copies, and don't change with later edits:
+
+    >>> m = inc.matches()[0][1]
+    >>> inc.replace(1, 3, 'black')
+    >>> m(), inc.matches()[0][1]()
+    ('the big fat cat', 'the black cat')
+    """
+    def __init__(self, pattern, sen=(), overlapped=True):
+        self.pattern = pattern
+        self.program = pattern.program
+        self.overlapped = overlapped
+        self.text = Text([], self.program.folding)
+        # offset -> Span of the match in self.text, or None; the Span is
+        # as it was found, at the offset it had then
+        self.results = [None]
+        # the number of times each regular word of the pattern occurs, for
+        # rejecting the sentence as Program.rejects does
+        self.counts = Counter()
+        self.rejected = True
+        self.replace(0, 0, sen)
+
+    def __len__(self):
+        return len(self.text)
+
+    def __str__(self):
+        return str(SList(self.text.elems))
+
+    def insert(self, i, sen):
+        """Insert the elements of `sen` before the element at `i`."""
+        self.replace(i, i, sen)
+
+    def delete(self, start, end):
+        """Delete the elements from `start` to `end`."""
+        self.replace(start, end, ())
+
+    def replace(self, start, end, sen):
+        """Replace the elements from `start` to `end` with those of `sen`,
+        and match the pattern again where the edit may change the
+        result."""
+        text = self.text
+        if not 0 <= start <= end <= len(text):
+            raise IndexError("the edit is outside the sentence")
+        program = self.program
+        new = Text(tokens(sen, self.pattern.tokenizer), program.folding)
+        literals = program.literals
+        self.counts.subtract(key for key in text.keys[start:end]
+                             if key in literals)
+        self.counts.update(key for key in new.keys if key in literals)
+        text.elems[start:end] = new.elems
+        text.keys[start:end] = new.keys
+        # the memos of functions are kept by position
+        text.tested.clear()
+        text.masks.clear()
+
+        # The results at the offsets from `end` on move with the elements;
+        # those from `low` up to the end of the new elements are found
+        # again.
+        stop = start + len(new)
+        if program.width == float('inf'):
+            low = 0
+        else:
+            low = max(start - program.width, 0)
+        self.results[low:end] = [None] * (stop - low)
+        rejected = (len(text) < program.min_width or
+                    any(self.counts[key] <= 0 for key in literals))
+        if rejected:
+            self.results = [None] * (len(text) + 1)
+        elif self.rejected:
+            self.rematch(0, len(text) + 1)
+        else:
+            self.rematch(low, stop)
+        self.rejected = rejected
+
+    def rematch(self, low, high):
+        # match the pattern at the offsets from `low` to `high` again,
+        # skipping to those where the prefix of the pattern occurs
+        program = self.program
+        text = self.text
+        end = len(text)
+        keys = text.keys
+        limit = min(end, high + len(program.prefix) - 1)
+        failed = set()
+        i = program.next_start(keys, low, limit)
+        while i is not None and i < high:
+            self.results[i] = program.match(text, i, end, failed=failed)
+            i = program.next_start(keys, i + 1, limit)
+
+    def match_at(self, i):
+        # The match object of the Span kept at the offset. The offset of
+        # the Span has moved with its elements, and so have its groups at
+        # the top level of the text, by as many elements as the edits
+        # since it was found have put in or taken out before it.
+        span = self.results[i]
+        text = self.text
+        shift = i - span.start
+        if shift:
+            groups = {name: Span(text, group.start + shift,
+                                 group.end + shift)
+                      if group.text is text else group
+                      for (name, group) in span.groups.items()}
+            span = Span(text, i, span.end + shift, groups)
+        return UserMatch(rebase(span, text))
+
+    def matches(self):
+        """Return the (offset, match) pairs of the matches in the
+        sentence."""
+        results = self.results
+        if self.overlapped:
+            return [(i, self.match_at(i)) for (i, m) in enumerate(results)
+                    if m is not None]
+        found = []
+        i = 0
+        while i < len(results):
+            m = results[i]
+            if m is None:
+                i += 1
+            else:
+                found.append((i, self.match_at(i)))
+                # an empty match is followed by the next offset
+                i += max(len(m), 1)
+        return found
+
+
+# The command line interface: python -m nlre --help
+
+def main(argv=None):
+    """Print the matches of patterns in a file of sentences as JSON Lines.
+
+    The file is memory-mapped and split into chunks of whole sentences,
+    which worker processes search. Each match is printed as a JSON object
+    with the number of its sentence (counted from 1; with one sentence
+    per line, the line number), the index of the pattern, the span and
+    the text of the match, and its named groups. The matches are printed
+    in the order of the sentences. The exit status is 0 if there was a
+    match and 1 otherwise, as for grep.
+
+    >>> import contextlib, io, tempfile
+    >>> tmp = tempfile.TemporaryDirectory()
+    >>> lines = os.path.join(tmp.name, 'lines.txt')
+    >>> with open(lines, 'w') as file:
+    ...     _ = file.write('The big dog\\nno match\\na big cat saw the old dog\\n')
+    >>> main(['the #x dog', lines])
+    {"sentence": 1, "pattern": 0, "span": [0, 3], "match": "The big dog", "groups": {"x": "big"}}
+    {"sentence": 3, "pattern": 0, "span": [4, 7], "match": "the old dog", "groups": {"x": "old"}}
+    0
+    >>> main(['the #x cow', lines])
+    1
+
+    The output is the same whatever the number of workers and the size
+    of the chunks, with one sentence per line or with --brackets:
+
+    >>> brackets = os.path.join(tmp.name, 'brackets.txt')
+    >>> with open(brackets, 'w') as file:
+    ...     _ = file.write('[The big dog] [no\\nmatch] [a [big] cat\\n'
+    ...                    'saw the old dog]\\n[big dog]')
+    >>> def output(*args):
+    ...     out = io.StringIO()
+    ...     with contextlib.redirect_stdout(out):
+    ...         main(['the #x dog', '#? big #y', *args])
+    ...     return out.getvalue()
+    >>> for args in [[lines], [brackets, '--brackets']]:
+    ...     expected = output(*args, '--workers', '1')
+    ...     print(len(expected.splitlines()), all(
+    ...         output(*args, '--workers', str(workers), '--chunk-size',
+    ...                str(size)) == expected
+    ...         for workers in [1, 2] for size in [1, 5, 1 << 22]))
+    6 True
+    5 True
+    >>> tmp.cleanup()
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m nlre',
+        description=main.__doc__.split('\n\n')[0])
+    parser.add_argument('patterns', nargs='+', metavar='pattern')
+    parser.add_argument('file')
+    parser.add_argument('--brackets', action='store_true',
+                        help='the sentences are bracketed lists, which may '
+                             'span lines, rather than lines')
+    parser.add_argument('--case', default='lower', choices=list(cases),
+                        help='how words are folded before they are compared')
+    parser.add_argument('--no-overlap', dest='overlapped',
+                        action='store_false',
+                        help='resume the search after the end of a match')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='the number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=1 << 22,
+                        help='the least number of bytes per task')
+    parser.add_argument('--import', dest='modules', action='append',
+                        default=[], metavar='MODULE',
+                        help='import a module, which may add functions to '
+                             'the functions dictionary, first')
+    args = parser.parse_args(argv)
+
+    for module in args.modules:
+        importlib.import_module(module)
+    patterns = [Pattern(pat, args.case) for pat in args.patterns]
+    found = False
+    with open(args.file, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return 1
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            bounds = chunk_bounds(data, args.chunk_size, args.brackets)
+            if args.workers <= 1:
+                state = (data, patterns, args.brackets, args.overlapped)
+                results = (scan(bound, state) for bound in bounds)
+            else:
+                # the patterns are unpickled by the workers once they have
+                # the functions, which the special elements look up
+                initargs = (args.file,
+                            pickle.dumps(patterns, pickle.HIGHEST_PROTOCOL),
+                            args.brackets, args.overlapped, functions)
+                results = run_scan(bounds, args.workers, initargs)
+            number = 1  # of the first sentence of the chunk
+            write = sys.stdout.write
+            for (count, records) in results:
+                for (i, record) in records:
+                    # the number goes in front of the rest of the record,
+                    # which the worker has already encoded
+                    write('{{"sentence": {0}, {1}\n'.format(number + i,
+                                                            record))
+                    found = True
+                number += count
+    return 0 if found else 1
+
+
+def chunk_bounds(data, size, brackets):
+    """Generate the (start, end) offsets of chunks of whole sentences of
+    the bytes `data`, of at least `size` bytes each but the last. A chunk
+    ends with a line, or, with `brackets`, where the depth of the brackets
+    is back to 0; the depth is counted by bytes.count, so the data are
+    only scanned in C.
+
+    >>> list(chunk_bounds(b'one\\ntwo three\\nfour\\n', 5, False))
+    [(0, 14), (14, 19)]
+    >>> list(chunk_bounds(b'[a [b]] [c\\n d] [e]', 2, True))
+    [(0, 7), (7, 14), (14, 18)]
+    """
+    def depth_change(start, end):
+        piece = data[start:end]
+        return piece.count(b'[') - piece.count(b']')
+
+    start = 0
+    depth = 0  # of the brackets at `start`
+    while start < len(data):
+        end = start + size
+        if end >= len(data):
+            yield start, len(data)
+            return
+        if brackets:
+            depth += depth_change(start, end)
+            while depth > 0:
+                close = data.find(b']', end)
+                if close == -1:
+                    end = len(data)
+                    break
+                depth += depth_change(end, close + 1)
+                end = close + 1
+        else:
+            end = data.find(b'\n', end)
+            end = len(data) if end == -1 else end + 1
+        yield start, end
+        start = end
+
+
+def run_scan(bounds, workers, initargs):
+    # scan the chunks in a pool of worker processes, and generate the
+    # results in order; at most two chunks per worker are queued
+    with ProcessPoolExecutor(workers, initializer=init_scan,
+                             initargs=initargs) as executor:
+        pending = deque()
+        while True:
+            for bound in islice(bounds, 2 * workers - len(pending)):
+                pending.append(executor.submit(scan, bound))
+            if not pending:
+                break
+            yield pending.popleft().result()
+
+
+scan_state = None  # the file and the options of scan() in a worker
+
+
+def init_scan(path, patterns, brackets, overlapped, funs):
+    # set up a worker process; the file and its map are open for as long
+    # as the process lives
+    global scan_state
+    functions.update(funs)
+    file = open(path, 'rb')
+    data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    scan_state = (data, pickle.loads(patterns), brackets, overlapped)
+
+
+def scan(bound, state=None):
+    # Search the sentences of a chunk of the file. Return the number of
+    # sentences, and the (index of the sentence, JSON object without its
+    # opening brace and the sentence number) pairs of the matches.
+    # `state` is that of scan_state, which it is by default.
+    data, patterns, brackets, overlapped = state or scan_state
+    chunk = data[bound[0]:bound[1]].decode('utf-8')
+    if brackets:
+        sens = list(iterparse([chunk]))
+        for sen in sens:
+            if not isinstance(sen, list):
+                raise ValueError("the word '{0}' is outside ".format(sen) +
+                                 "the brackets of the sentences")
+    else:
+        sens = chunk.split('\n')
+        if sens[-1] == '':
+            del sens[-1]
+    records = []
+    for (i, sen) in enumerate(sens):
+        text = patterns[0].text(sen)
+        for (index, pattern) in enumerate(patterns):
+            for m in pattern.program.finditer(text, overlapped):
+                m = UserMatch(m)
+                record = json.dumps({'pattern': index,
+                                     'span': m.span(),
+                                     'match': m(),
+                                     'groups': m.groupdict()},
+                                    ensure_ascii=False)
+                records.append((i, record[1:]))
+    return len(sens), records
+
+
+if __name__ == "__main__":
+    # run the command line interface in the module proper, whose
+    # functions dictionary modules given with --import fill; the tests
+    # are run with python -m doctest nlre.py
+    import nlre
+    sys.exit(nlre.main())
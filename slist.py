@@ -1,96 +1,135 @@
-"""
-Handling string representations of structured lists.
-
-The string representations of structured lists are modelled upon Logo lists,
-which facilitate computing lists of words. For example, the string
-representation of
-    ['one', ['two', ['three', 'four']], 'five']
-is
-    'one [two [three four]] five'
-
-This module provides the SList (which stands for structured list) class, which
-has two methods for conversion between the string form and the SList object
-form:
-    __init__    Construct a SList object from the argument.
-    __str__     Return a string representing the SList.
-"""
-
-
-class SList(list):
-    def __init__(self, arg=None):
-        """Construct a structured list object from the argument.
-
-        If the argument is a list, then its members will be converted using
-        their '__str__' method if they are not 'list' instances; if they are,
-        they will be converted to structured lists recursively.
-
-        >>> SList(['one', ['two', ['three', 'four']], 5])
-        ['one', ['two', ['three', 'four']], '5']
-
-        If the argument is a string, conversion works as in the following
-        example:
-
-        >>> SList('one [two [three four]] five')
-        ['one', ['two', ['three', 'four']], 'five']
-
-        If unbalanced brackets are detected, ValueError is raised.
-        For example,
-
-        >>> SList('aaa [bbb [ccc]')
-        Traceback (most recent call last):
-            ...
-        ValueError: brackets not balanced
-        """
-        if arg is None:
-            super().__init__()
-
-        elif isinstance(arg, list):
-            super().__init__(SList(elem) if isinstance(elem, list)
-                             else str(elem) for elem in arg)
-
-        elif isinstance(arg, str):
-            opened = 0  # counts opened square brackets
-            for (i, char) in enumerate(arg):
-                if char == "[":
-                    opened += 1
-                    if opened == 1:  # the first bracket
-                        left = i
-                elif char == "]":
-                    opened -= 1
-                    if opened == 0:  # brackets closed
-                        right = i
-                        break
-                    elif opened == -1:
-                        # the first found bracket is a right bracket
-                        raise ValueError("brackets not balanced")
-            else:
-                if opened > 0:
-                    # an opening bracket was found it was not balanced
-                    raise ValueError("brackets not balanced")
-                else:
-                    # no brackets were found
-                    super().__init__(arg.split())
-                    return
-                    
-            before = arg[:left]
-            sublist = arg[left+1:right]
-            after = arg[right+1:]
-            super().__init__(before.split() + [SList(sublist)] + SList(after))
-
-        else:
-            raise TypeError("the argument to SList must be either a list "
-                            "or a string")
-
-    def __str__(self):
-        """Return a string representing the structured list.
-
-        >>> str(SList('one [two [three four]] five'))
-        'one [two [three four]] five'
-        """
-        return ' '.join('[{0}]'.format(str(elem)) if isinstance(elem, list)
-                        else elem for elem in self)
-
-
-if __name__ == "__main__":
-    import doctest
-    doctest.testmod()
+"""
+Handling string representations of structured lists.
+
+The string representations of structured lists are modelled upon Logo lists,
+which facilitate computing lists of words. For example, the string
+representation of
+    ['one', ['two', ['three', 'four']], 'five']
+is
+    'one [two [three four]] five'
+
+This module provides the SList (which stands for structured list) class, which
+has two methods for conversion between the string form and the SList object
+form:
+    __init__    Construct a SList object from the argument.
+    __str__     Return a string representing the SList.
+
+The string form can also be read in chunks, from a file object or any other
+iterable of strings, with the iterparse generator.
+"""
+
+import re
+
+
+# words and square brackets in the string form
+token = re.compile(r"[\[\]]|[^\s\[\]]+")
+
+
+class SList(list):
+    def __init__(self, arg=None):
+        """Construct a structured list object from the argument.
+
+        If the argument is a list or a tuple, then its members will be
+        converted using their '__str__' method if they are not 'list' or
+        'tuple' instances; if they are, they will be converted to structured
+        lists recursively.
+
+        >>> SList(['one', ['two', ('three', 'four')], 5])
+        ['one', ['two', ['three', 'four']], '5']
+
+        If the argument is a string, conversion works as in the following
+        example:
+
+        >>> SList('one [two [three four]] five')
+        ['one', ['two', ['three', 'four']], 'five']
+
+        If unbalanced brackets are detected, ValueError is raised.
+        For example,
+
+        >>> SList('aaa [bbb [ccc]')
+        Traceback (most recent call last):
+            ...
+        ValueError: brackets not balanced
+        """
+        if arg is None:
+            super().__init__()
+
+        elif isinstance(arg, (list, tuple)):
+            super().__init__(SList(elem) if isinstance(elem, (list, tuple))
+                             else str(elem) for elem in arg)
+
+        elif isinstance(arg, str):
+            super().__init__(iterparse((arg,)))
+
+        else:
+            raise TypeError("the argument to SList must be either a list, "
+                            "a tuple or a string")
+
+    def __str__(self):
+        """Return a string representing the structured list.
+
+        >>> str(SList('one [two [three four]] five'))
+        'one [two [three four]] five'
+        """
+        return ' '.join('[{0}]'.format(str(elem)) if isinstance(elem, list)
+                        else elem for elem in self)
+
+
+def iterparse(chunks):
+    """Parse the string form of a structured list given in chunks.
+
+    `chunks` is an iterable of strings, such as a file object, whose
+    concatenation is the string form; a word or a sublist may be split
+    between chunks. The elements of the outermost list are generated as
+    soon as they are complete, so the whole string need not be in memory.
+    Sublists are SList objects.
+
+    >>> list(iterparse(['one [tw', 'o [three]] fo', 'ur']))
+    ['one', ['two', ['three']], 'four']
+
+    The string is read once, and nested sublists are built on an explicit
+    stack, so the time is linear in the length of the string.
+    ValueError is raised if the brackets are not balanced.
+
+    >>> list(iterparse(['one] two']))
+    Traceback (most recent call last):
+        ...
+    ValueError: brackets not balanced
+    """
+    stack = []  # the sublists being built, the innermost one last
+    partial = ""  # a word which may continue in the next chunk
+    for chunk in chunks:
+        if partial:
+            chunk = partial + chunk
+            partial = ""
+        for m in token.finditer(chunk):
+            tok = m.group()
+            if tok == "[":
+                stack.append(SList())
+                continue
+            elif tok == "]":
+                if not stack:
+                    raise ValueError("brackets not balanced")
+                elem = stack.pop()
+            elif m.end() == len(chunk):
+                partial = tok
+                continue
+            else:
+                elem = tok
+            if stack:
+                stack[-1].append(elem)
+            else:
+                yield elem
+    if partial:
+        if stack:
+            stack[-1].append(partial)
+        else:
+            yield partial
+    if stack:
+        # an opening bracket was not balanced
+        raise ValueError("brackets not balanced")
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()